@@ -4,6 +4,7 @@ from rest_framework.decorators import action
 from rest_framework.response import Response
 from wagtail.models import Page, Site
 
+from .cache import variant_pages
 from .models import AbTest
 
 
@@ -72,7 +73,7 @@ class AbTestViewSet(viewsets.ReadOnlyModelViewSet):
         test = self.get_object()
         request.wagtail_ab_testing_test = test
         request.wagtail_ab_testing_serving_variant = True
-        return test.variant_revision.as_object().serve(request)
+        return variant_pages.get_variant_page(test, request).serve(request)
 
     @action(detail=True, methods=["post"])
     def add_participant(self, request, pk=None):
@@ -0,0 +1,581 @@
+import copy
+import hashlib
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection
+from django.db.models import F
+from django.http import HttpResponse
+
+# The primary key of the AbTestingState row that holds the shared generation
+STATE_ID = 1
+
+# Bumped whenever an A/B test is saved or deleted in this process
+_local_generation = 0
+
+# The last value of the generation that is shared between all processes
+# through the database, and when it was fetched
+_shared_generation = None
+_shared_generation_checked_at = None
+
+_generation_lock = threading.Lock()
+
+
+def get_cache():
+    """
+    Returns the Django cache that is used for data that's shared between processes, such as rendered responses and rate limits.
+    """
+    return caches[getattr(settings, "WAGTAIL_AB_TESTING_CACHE", "default")]
+
+
+def run_cache_operations(operations):
+    """
+    Runs the cache operations yielded by a generator, and returns what the generator returns.
+
+    The generator yields (method_name, *args) tuples for methods of the cache
+    from get_cache(). It's sent the result of each call, or has the ValueError
+    that the call raised thrown into it. This allows logic that works with the
+    cache to be shared with async code, see arun_cache_operations().
+    """
+    cache = get_cache()
+
+    try:
+        operation = next(operations)
+        while True:
+            method_name, *args = operation
+            try:
+                result = getattr(cache, method_name)(*args)
+            except ValueError as e:
+                operation = operations.throw(e)
+            else:
+                operation = operations.send(result)
+    except StopIteration as e:
+        return e.value
+
+
+async def arun_cache_operations(operations):
+    """
+    Asynchronous version of run_cache_operations(), which calls the async method of the cache for each operation.
+    """
+    cache = get_cache()
+
+    try:
+        operation = next(operations)
+        while True:
+            method_name, *args = operation
+            try:
+                result = await getattr(cache, "a" + method_name)(*args)
+            except ValueError as e:
+                operation = operations.throw(e)
+            else:
+                operation = operations.send(result)
+    except StopIteration as e:
+        return e.value
+
+
+def _fetch_shared_generation():
+    from .models import AbTestingState
+
+    return (
+        AbTestingState.objects.filter(id=STATE_ID)
+        .values_list("generation", flat=True)
+        .first()
+    )
+
+
+def _shared_generation_is_fresh():
+    interval = getattr(settings, "WAGTAIL_AB_TESTING_STATE_CHECK_INTERVAL", 1)
+    now = time.monotonic()
+
+    return (
+        _shared_generation_checked_at is not None
+        and now - _shared_generation_checked_at < interval
+        # The clock has been changed, for example by freezegun in tests
+        and now >= _shared_generation_checked_at
+    )
+
+
+def _get_shared_generation():
+    global _shared_generation, _shared_generation_checked_at
+
+    if not _shared_generation_is_fresh():
+        _shared_generation = _fetch_shared_generation()
+        _shared_generation_checked_at = time.monotonic()
+
+    return _shared_generation
+
+
+def get_shared_generation(request=None):
+    """
+    Returns the A/B test state generation that is shared between all processes.
+
+    This is fetched from the database at most once per request if one is
+    passed in, and at most once every WAGTAIL_AB_TESTING_STATE_CHECK_INTERVAL
+    seconds.
+    """
+    if request is None:
+        return _get_shared_generation()
+
+    try:
+        return request._wagtail_ab_testing_shared_generation
+    except AttributeError:
+        shared_generation = _get_shared_generation()
+        request._wagtail_ab_testing_shared_generation = shared_generation
+        return shared_generation
+
+
+async def aget_shared_generation(request=None):
+    """
+    Asynchronous version of get_shared_generation().
+
+    This only leaves the event loop when the generation needs to be fetched from the database.
+    """
+    try:
+        return request._wagtail_ab_testing_shared_generation
+    except AttributeError:
+        pass
+
+    if _shared_generation_is_fresh():
+        shared_generation = _shared_generation
+    else:
+        shared_generation = await sync_to_async(_get_shared_generation)()
+
+    if request is not None:
+        request._wagtail_ab_testing_shared_generation = shared_generation
+
+    return shared_generation
+
+
+def get_generation(request=None):
+    """
+    Returns the current A/B test state generation.
+
+    Anything that caches A/B test state in this process compares against this
+    value to find out whether its copy is still valid.
+    """
+    # Changes made in this process take effect immediately
+    return (_local_generation, get_shared_generation(request))
+
+
+async def aget_generation(request=None):
+    """
+    Asynchronous version of get_generation().
+    """
+    return (_local_generation, await aget_shared_generation(request))
+
+
+def bump_generation():
+    """
+    Invalidates all cached A/B test state in every process.
+    """
+    from .models import AbTestingState
+
+    global _local_generation, _shared_generation_checked_at
+
+    if not AbTestingState.objects.filter(id=STATE_ID).update(
+        generation=F("generation") + 1
+    ):
+        AbTestingState.objects.get_or_create(id=STATE_ID)
+
+    with _generation_lock:
+        _local_generation += 1
+
+        # Fetch the new value the next time it's needed
+        _shared_generation_checked_at = None
+
+
+class RunningTestRegistry:
+    """
+    A process-local snapshot of the A/B tests that are currently running, keyed by page ID.
+
+    This allows the page serve hook to find out whether a page has a running
+    test without querying the database. The snapshot is reloaded with a single
+    query the first time it's used after the state generation has changed.
+    The tests are also indexed by their goal page.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._generation = None
+        self._tests_by_page_id = {}
+        self._tests_by_goal = {}
+
+    def _load(self):
+        from .models import AbTest
+
+        return list(
+            AbTest.objects.filter(status=AbTest.STATUS_RUNNING).select_related(
+                "variant_revision"
+            )
+        )
+
+    def _update(self, generation):
+        tests_by_page_id = {}
+        tests_by_goal = defaultdict(list)
+
+        for ab_test in self._load():
+            tests_by_page_id[ab_test.page_id] = ab_test
+            tests_by_goal[(ab_test.goal_page_id, ab_test.goal_event)].append(ab_test)
+
+        self._tests_by_page_id = tests_by_page_id
+        self._tests_by_goal = dict(tests_by_goal)
+        self._generation = generation
+
+    def _check_generation(self, request=None):
+        generation = get_generation(request)
+
+        if self._generation != generation:
+            with self._lock:
+                if self._generation != generation:
+                    self._update(generation)
+
+    def get_for_page(self, page_id, request=None):
+        """
+        Returns the running A/B test for the given page ID or None if there isn't one.
+
+        The returned instance is a copy so callers are free to modify it.
+        """
+        self._check_generation(request)
+        ab_test = self._tests_by_page_id.get(page_id)
+
+        if ab_test is not None:
+            return copy.copy(ab_test)
+
+    def get_for_goal(self, goal_page_id, goal_event, request=None):
+        """
+        Returns a list of the running A/B tests that have the given goal.
+
+        Tests with a goal_page_id of None can be reached on any page.
+        """
+        self._check_generation(request)
+
+        return [
+            copy.copy(ab_test)
+            for ab_test in self._tests_by_goal.get((goal_page_id, goal_event), [])
+        ]
+
+
+running_tests = RunningTestRegistry()
+
+
+class TestStatusRegistry:
+    """
+    A process-local map of the IDs of all A/B tests to their status.
+
+    This allows the tracking endpoints to reject events for tests that don't
+    exist, or drop events for tests that aren't running, without querying the
+    database. The map is reloaded with a single query the first time it's used
+    after the state generation has changed.
+
+    It also keeps when each test was first started, so events that claim to
+    have happened before that can be dropped.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._generation = None
+        self._statuses = {}
+        self._first_started_at = {}
+
+    def _load(self):
+        from .models import AbTest
+
+        statuses = {}
+        first_started_at = {}
+        for ab_test_id, status, started_at in AbTest.objects.values_list(
+            "id", "status", "first_started_at"
+        ):
+            statuses[ab_test_id] = status
+            first_started_at[ab_test_id] = started_at
+
+        return statuses, first_started_at
+
+    def _update(self, generation):
+        with self._lock:
+            if self._generation != generation:
+                self._statuses, self._first_started_at = self._load()
+                self._generation = generation
+
+    def get_status(self, ab_test_id, request=None):
+        """
+        Returns the status of the A/B test with the given ID or None if it doesn't exist.
+        """
+        generation = get_generation(request)
+
+        if self._generation != generation:
+            self._update(generation)
+
+        return self._statuses.get(ab_test_id)
+
+    async def aget_status(self, ab_test_id, request=None):
+        """
+        Asynchronous version of get_status().
+        """
+        generation = await aget_generation(request)
+
+        if self._generation != generation:
+            await sync_to_async(self._update)(generation)
+
+        return self._statuses.get(ab_test_id)
+
+    def get_first_started_at(self, ab_test_id):
+        """
+        Returns when the A/B test with the given ID was first started, or None if it hasn't been.
+
+        This doesn't check the state generation, so it should only be called
+        after get_status() or aget_status() for the same request.
+        """
+        return self._first_started_at.get(ab_test_id)
+
+
+test_statuses = TestStatusRegistry()
+
+
+class VariantPageCache:
+    """
+    A process-local LRU cache of variant pages, keyed by revision ID.
+
+    Deserializing a revision is expensive for pages with a lot of content, so
+    this keeps the materialized page objects of running A/B tests in memory.
+    Callers always get a deep copy so nothing they do to it can leak into
+    other requests.
+
+    The maximum number of pages is configured by the
+    WAGTAIL_AB_TESTING_VARIANT_CACHE_SIZE setting. The cache is emptied when
+    the state generation changes, so pages of tests that have been paused or
+    ended don't stay in memory.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._generation = None
+        self._pages = OrderedDict()
+
+    def _get_max_size(self):
+        return getattr(settings, "WAGTAIL_AB_TESTING_VARIANT_CACHE_SIZE", 100)
+
+    def _check_generation(self, request=None):
+        generation = get_generation(request)
+
+        if self._generation != generation:
+            with self._lock:
+                self._pages.clear()
+                self._generation = generation
+
+        return generation
+
+    def get_variant_page(self, ab_test, request=None):
+        """
+        Returns the page object of the given A/B test's variant revision.
+        """
+        max_size = self._get_max_size()
+        if not max_size or ab_test.status != ab_test.STATUS_RUNNING:
+            return ab_test.variant_revision.as_object()
+
+        generation = self._check_generation(request)
+
+        revision_id = ab_test.variant_revision_id
+
+        with self._lock:
+            page = self._pages.get(revision_id)
+            if page is not None:
+                self._pages.move_to_end(revision_id)
+
+        if page is None:
+            page = ab_test.variant_revision.as_object()
+
+            with self._lock:
+                # Don't store the page if the cache was emptied while it was being loaded
+                if self._generation == generation:
+                    self._pages[revision_id] = page
+                    while len(self._pages) > max_size:
+                        self._pages.popitem(last=False)
+
+        return copy.deepcopy(page)
+
+
+variant_pages = VariantPageCache()
+
+
+class RenderedResponseCache:
+    """
+    Caches the rendered HTML of the control and variant versions of tested pages.
+
+    Both versions of a tested page are the same for every anonymous visitor, so
+    they can be rendered once and served from the Django cache until the
+    A/B test's state changes or the page is published.
+
+    This is disabled unless WAGTAIL_AB_TESTING_RESPONSE_CACHE_TIMEOUT is set.
+    The WAGTAIL_AB_TESTING_RESPONSE_CACHE_VARY_ON setting may contain a list of
+    request headers that the rendered pages vary on.
+    """
+
+    def _get_timeout(self):
+        return getattr(settings, "WAGTAIL_AB_TESTING_RESPONSE_CACHE_TIMEOUT", None)
+
+    def is_cacheable_request(self, request):
+        """
+        Returns True if the response to the given request can be cached.
+        """
+        if not self._get_timeout():
+            return False
+
+        if request.method not in ["GET", "HEAD"]:
+            return False
+
+        user = getattr(request, "user", None)
+        return user is None or not user.is_authenticated
+
+    def _get_key(self, request, ab_test, version):
+        vary_on = getattr(settings, "WAGTAIL_AB_TESTING_RESPONSE_CACHE_VARY_ON", [])
+        key = "\n".join(
+            [
+                # Including the generation means that all cached responses
+                # are invalidated whenever the state of any test changes
+                str(get_shared_generation(request)),
+                str(ab_test.id),
+                version,
+                request.get_host(),
+                request.get_full_path(),
+            ]
+            + [request.headers.get(header, "") for header in vary_on]
+        )
+
+        return (
+            "wagtail-ab-testing:response:"
+            + hashlib.sha256(key.encode("utf-8")).hexdigest()
+        )
+
+    def get(self, request, ab_test, version):
+        """
+        Returns the cached response for the given version or None if it isn't cached.
+        """
+        cached = get_cache().get(self._get_key(request, ab_test, version))
+        if cached is None:
+            return
+
+        status, headers, content = cached
+        response = HttpResponse(content, status=status)
+        for header, value in headers:
+            response[header] = value
+
+        return response
+
+    def set(self, request, ab_test, version, response):
+        """
+        Caches the given rendered response if it doesn't contain anything specific to the visitor.
+        """
+        if response.status_code != 200 or response.streaming or response.cookies:
+            return
+
+        # The page used a CSRF token, which is specific to the visitor
+        if request.META.get("CSRF_COOKIE_NEEDS_UPDATE"):
+            return
+
+        get_cache().set(
+            self._get_key(request, ab_test, version),
+            (response.status_code, list(response.items()), response.content),
+            self._get_timeout(),
+        )
+
+
+rendered_responses = RenderedResponseCache()
+
+
+class ParticipantCountCache:
+    """
+    A process-local tally of the number of participants in each version of the running A/B tests.
+
+    New visitors are shown whichever version has fewer participants, but
+    counting them requires aggregating all of a test's hourly logs. This keeps
+    approximate numbers in memory so that decision doesn't need a query.
+
+    The numbers are loaded from the database the first time they're needed,
+    updated when participants are added by this process, and refreshed in a
+    background thread once they are older than
+    WAGTAIL_AB_TESTING_PARTICIPANT_COUNTS_MAX_AGE seconds so that participants
+    added by other processes are taken into account.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._generation = None
+        # Maps A/B test IDs to a list of [control, variant, time loaded]
+        self._counts = {}
+        self._refreshing = set()
+
+    def _get_max_age(self):
+        return getattr(settings, "WAGTAIL_AB_TESTING_PARTICIPANT_COUNTS_MAX_AGE", 30)
+
+    def _check_generation(self, request=None):
+        generation = get_generation(request)
+
+        if self._generation != generation:
+            with self._lock:
+                self._counts.clear()
+                self._generation = generation
+
+    def _load(self, ab_test_id):
+        from .models import AbTestTotals
+
+        control, _, variant, _ = AbTestTotals._get_totals([ab_test_id]).get(
+            ab_test_id, (0, 0, 0, 0)
+        )
+
+        with self._lock:
+            self._counts[ab_test_id] = [control, variant, time.monotonic()]
+
+        return control, variant
+
+    def _refresh(self, ab_test_id):
+        try:
+            self._load(ab_test_id)
+        finally:
+            with self._lock:
+                self._refreshing.discard(ab_test_id)
+
+            # This thread has its own database connection
+            connection.close()
+
+    def _refresh_in_background(self, ab_test_id):
+        with self._lock:
+            if ab_test_id in self._refreshing:
+                return
+
+            self._refreshing.add(ab_test_id)
+
+        threading.Thread(target=self._refresh, args=[ab_test_id], daemon=True).start()
+
+    def get(self, ab_test, request=None):
+        """
+        Returns a 2-tuple containing the approximate number of participants who were given the control or variant version of the page respectively.
+        """
+        self._check_generation(request)
+
+        counts = self._counts.get(ab_test.id)
+        if counts is None:
+            return self._load(ab_test.id)
+
+        control, variant, loaded_at = counts
+        if time.monotonic() - loaded_at >= self._get_max_age():
+            self._refresh_in_background(ab_test.id)
+
+        return control, variant
+
+    def increment(self, ab_test_id, version, participants=1):
+        """
+        Records that participants have been added to the given version of an A/B test.
+        """
+        from .models import AbTest
+
+        with self._lock:
+            counts = self._counts.get(ab_test_id)
+            if counts is not None:
+                counts[0 if version == AbTest.VERSION_CONTROL else 1] += participants
+
+
+participant_counts = ParticipantCountCache()
@@ -1,5 +1,10 @@
 import os
 
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
 if os.name == "nt":
     # Windows has a different strftime format for dates without leading 0
     # https://stackoverflow.com/questions/904928/python-strftime-date-without-leading-0
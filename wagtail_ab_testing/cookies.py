@@ -0,0 +1,196 @@
+import re
+
+from django.conf import settings
+
+from .cache import test_statuses
+from .models import AbTest
+
+# All of a visitor's assignments are kept in one cookie that looks like "12:c|15:v"
+ASSIGNMENTS_COOKIE_NAME = "wagtail-ab-testing"
+ASSIGNMENTS_COOKIE_MAX_AGE = 365 * 24 * 60 * 60
+
+VERSION_CODES = {
+    AbTest.VERSION_CONTROL: "c",
+    AbTest.VERSION_VARIANT: "v",
+}
+
+VERSIONS_BY_CODE = {code: version for version, code in VERSION_CODES.items()}
+
+# The IDs of the tests that the visitor has reached the goal of, like "12|15"
+# This stops conversions from being counted by both the server and the tracker
+CONVERSIONS_COOKIE_NAME = "wagtail-ab-testing-conversions"
+
+# Older versions of the tracker set a separate cookie for each test
+# These are still read so visitors don't switch versions during the transition
+LEGACY_COOKIE_NAME_RE = re.compile(r"^wagtail-ab-testing_(\d+)_version$")
+
+# Legacy cookies for tests with any other status are deleted
+ACTIVE_STATUSES = [AbTest.STATUS_DRAFT, AbTest.STATUS_RUNNING, AbTest.STATUS_PAUSED]
+
+
+def parse_assignments(value):
+    """
+    Parses the value of the assignments cookie into a dictionary of test IDs to versions.
+
+    Malformed entries are ignored.
+    """
+    assignments = {}
+
+    for entry in value.split("|"):
+        test_id, _, code = entry.partition(":")
+        if test_id.isdigit() and code in VERSIONS_BY_CODE:
+            assignments[int(test_id)] = VERSIONS_BY_CODE[code]
+
+    return assignments
+
+
+def get_legacy_cookie_names(request):
+    """
+    Returns a dictionary of test IDs to the names of any of the old per-test cookies that were sent with the request.
+    """
+    legacy_cookie_names = {}
+
+    for name in request.COOKIES:
+        match = LEGACY_COOKIE_NAME_RE.match(name)
+        if match:
+            legacy_cookie_names[int(match.group(1))] = name
+
+    return legacy_cookie_names
+
+
+def get_assignments(request):
+    """
+    Returns a dictionary of the IDs of the tests the visitor is participating in to the version they were shown.
+
+    The cookies are only parsed once per request.
+    """
+    if hasattr(request, "_wagtail_ab_testing_assignments"):
+        return request._wagtail_ab_testing_assignments
+
+    assignments = {}
+
+    for test_id, name in get_legacy_cookie_names(request).items():
+        if request.COOKIES[name] == AbTest.VERSION_VARIANT:
+            assignments[test_id] = AbTest.VERSION_VARIANT
+        else:
+            assignments[test_id] = AbTest.VERSION_CONTROL
+
+    # The compact cookie takes precedence over any legacy cookies that haven't been removed yet
+    assignments.update(
+        parse_assignments(request.COOKIES.get(ASSIGNMENTS_COOKIE_NAME, ""))
+    )
+
+    request._wagtail_ab_testing_assignments = assignments
+    return assignments
+
+
+def get_converted_test_ids(request):
+    """
+    Returns a set of the IDs of the tests that the visitor has already reached the goal of.
+
+    The set is shared for the rest of the request, so conversions that are
+    recorded while handling it can be added to it.
+    """
+    if hasattr(request, "_wagtail_ab_testing_converted_test_ids"):
+        return request._wagtail_ab_testing_converted_test_ids
+
+    converted_test_ids = {
+        int(test_id)
+        for test_id in request.COOKIES.get(CONVERSIONS_COOKIE_NAME, "").split("|")
+        if test_id.isdigit()
+    }
+
+    request._wagtail_ab_testing_converted_test_ids = converted_test_ids
+    return converted_test_ids
+
+
+def update_conversions_cookie(request, response):
+    """
+    Saves any conversions that were recorded while handling the request into the visitor's cookies.
+
+    Tests that the visitor isn't assigned to are forgotten.
+    """
+    value = "|".join(
+        str(test_id)
+        for test_id in sorted(get_converted_test_ids(request))
+        if test_id in get_assignments(request)
+    )
+
+    if value == request.COOKIES.get(CONVERSIONS_COOKIE_NAME, ""):
+        return
+
+    response.set_cookie(
+        CONVERSIONS_COOKIE_NAME,
+        value,
+        max_age=ASSIGNMENTS_COOKIE_MAX_AGE,
+        samesite="Lax",
+    )
+
+
+def get_visitor_id(request):
+    """
+    Returns the stable ID of the visitor or None if there isn't one.
+
+    This is read from the cookie named by WAGTAIL_AB_TESTING_VISITOR_ID_COOKIE,
+    which may be set by the tracker or by something in front of Wagtail.
+    """
+    cookie_name = getattr(settings, "WAGTAIL_AB_TESTING_VISITOR_ID_COOKIE", None)
+    if not cookie_name:
+        return
+
+    return request.COOKIES.get(cookie_name) or None
+
+
+def get_legacy_cookies_to_delete(request, active_test_ids):
+    """
+    Returns the names of the old per-test cookies that can be deleted.
+
+    These are the ones for tests that aren't in active_test_ids, and the
+    ones that the tracker has already copied into the assignments cookie.
+    """
+    assignments_cookie = parse_assignments(
+        request.COOKIES.get(ASSIGNMENTS_COOKIE_NAME, "")
+    )
+
+    return [
+        name
+        for test_id, name in get_legacy_cookie_names(request).items()
+        if test_id not in active_test_ids or test_id in assignments_cookie
+    ]
+
+
+def prune_assignments(request, response):
+    """
+    Deletes the old per-test cookies of tests that have ended, or that have been moved into the assignments cookie.
+
+    This is called from the tracking endpoints, which participants call
+    regularly. Test statuses are read from memory, so it doesn't usually
+    cost a query.
+
+    The assignments cookie itself is only ever written by the tracker. It
+    may add an assignment while the response is in flight, which setting the
+    cookie from the copy that was sent with the request would overwrite.
+    Assignments to tests that have ended are ignored when pages are served.
+    """
+    active_test_ids = {
+        test_id
+        for test_id in get_legacy_cookie_names(request)
+        if test_statuses.get_status(test_id, request) in ACTIVE_STATUSES
+    }
+
+    for name in get_legacy_cookies_to_delete(request, active_test_ids):
+        response.delete_cookie(name)
+
+
+async def aprune_assignments(request, response):
+    """
+    Asynchronous version of prune_assignments().
+    """
+    active_test_ids = {
+        test_id
+        for test_id in get_legacy_cookie_names(request)
+        if await test_statuses.aget_status(test_id, request) in ACTIVE_STATUSES
+    }
+
+    for name in get_legacy_cookies_to_delete(request, active_test_ids):
+        response.delete_cookie(name)
@@ -72,3 +72,47 @@ def get_event_types():
         event_types.update(fn())
 
     return event_types
+
+
+def record_event(request, event_slug, page=None):
+    """
+    Records that the visitor making the request has triggered the given goal event.
+
+    This is the server-side equivalent of wagtailAbTesting.triggerEvent() in the
+    browser. A conversion is recorded for each running A/B test that the visitor
+    is participating in with this goal, either on the given page or on any page.
+    Conversions are only recorded once per visitor and test if
+    ConversionMiddleware is installed to remember them in a cookie.
+
+    Returns a list of the IDs of the A/B tests that conversions were recorded for.
+    """
+    from .cache import running_tests
+    from .cookies import get_assignments, get_converted_test_ids
+    from .ingest import StatsBatch, record_batch
+    from .utils import request_is_trackable
+
+    if not request_is_trackable(request):
+        return []
+
+    ab_tests = running_tests.get_for_goal(None, event_slug, request)
+    if page is not None:
+        ab_tests += running_tests.get_for_goal(page.id, event_slug, request)
+
+    assignments = get_assignments(request)
+    converted_test_ids = get_converted_test_ids(request)
+    batch = StatsBatch()
+    recorded = []
+
+    for ab_test in ab_tests:
+        version = assignments.get(ab_test.id)
+        if version is None or ab_test.id in converted_test_ids:
+            continue
+
+        batch.add(ab_test.id, version, conversions=1)
+        converted_test_ids.add(ab_test.id)
+        recorded.append(ab_test.id)
+
+    if recorded:
+        record_batch(batch, len(recorded))
+
+    return recorded
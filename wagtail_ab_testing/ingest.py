@@ -0,0 +1,485 @@
+import atexit
+import hashlib
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import asynccontextmanager, contextmanager
+from datetime import datetime
+from datetime import timezone as tz
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections
+from django.db.models import F, Sum
+from django.utils.dateparse import parse_datetime
+
+from .cache import (
+    arun_cache_operations,
+    get_cache,
+    participant_counts,
+    run_cache_operations,
+)
+from .models import AbTest, AbTestHourlyLog
+
+logger = logging.getLogger(__name__)
+
+EVENT_KIND_PARTICIPANT = "participant"
+EVENT_KIND_CONVERSION = "conversion"
+
+EVENT_KINDS = [EVENT_KIND_PARTICIPANT, EVENT_KIND_CONVERSION]
+
+# Deltas from workers have their own scope of idempotency keys
+DELTA_KIND = "delta"
+
+MAX_IDEMPOTENCY_KEY_LENGTH = 100
+
+
+def _parse_test_id_and_version(data):
+    try:
+        test_id = int(data.get("test_id"))
+        if test_id < 1:
+            raise ValueError
+    except (TypeError, ValueError):
+        raise ValueError("test_id must be a positive integer") from None
+
+    version = data.get("version")
+    if version not in [AbTest.VERSION_CONTROL, AbTest.VERSION_VARIANT]:
+        raise ValueError(
+            f"version must be either '{AbTest.VERSION_CONTROL}' or '{AbTest.VERSION_VARIANT}'"
+        )
+
+    return test_id, version
+
+
+def _parse_time(data, field_name):
+    now = datetime.now(tz.utc)
+    time = data.get(field_name)
+    if time is None:
+        return now
+
+    try:
+        time = parse_datetime(time)
+    except (TypeError, ValueError):
+        time = None
+
+    if time is None:
+        raise ValueError(f"{field_name} must be an ISO 8601 date and time")
+
+    if time.tzinfo is None:
+        time = time.replace(tzinfo=tz.utc)
+
+    return min(time, now)
+
+
+def parse_idempotency_key(key):
+    """
+    Validates an optional idempotency key that was sent with an event. Returns None if there isn't one.
+    """
+    if key is None:
+        return
+
+    if not isinstance(key, str) or not 0 < len(key) <= MAX_IDEMPOTENCY_KEY_LENGTH:
+        raise ValueError(
+            f"key must be a string of up to {MAX_IDEMPOTENCY_KEY_LENGTH} characters"
+        )
+
+    return key
+
+
+def parse_event(data):
+    """
+    Validates a participant or conversion event that was posted to the tracking API.
+
+    Returns a (test_id, version, kind, time, key) tuple, or raises ValueError
+    with a message describing the problem. Times in the future are clamped to
+    now, and key is None if the event doesn't have an idempotency key.
+    """
+    if not isinstance(data, dict):
+        raise ValueError("each event must be an object")
+
+    test_id, version = _parse_test_id_and_version(data)
+
+    kind = data.get("kind")
+    if kind not in EVENT_KINDS:
+        raise ValueError(
+            f"kind must be either '{EVENT_KIND_PARTICIPANT}' or '{EVENT_KIND_CONVERSION}'"
+        )
+
+    return (
+        test_id,
+        version,
+        kind,
+        _parse_time(data, "time"),
+        parse_idempotency_key(data.get("key")),
+    )
+
+
+def parse_delta(data):
+    """
+    Validates a pre-aggregated count of participants and conversions that was posted by a worker.
+
+    Returns a (test_id, version, hour, participants, conversions, key) tuple,
+    or raises ValueError with a message describing the problem. Hours in the
+    future are clamped to now, and key is None if the delta doesn't have an
+    idempotency key.
+    """
+    if not isinstance(data, dict):
+        raise ValueError("each delta must be an object")
+
+    test_id, version = _parse_test_id_and_version(data)
+
+    counts = []
+    for field_name in ["participants", "conversions"]:
+        count = data.get(field_name, 0)
+        if isinstance(count, bool) or not isinstance(count, int) or count < 0:
+            raise ValueError(f"{field_name} must be a non-negative integer")
+
+        counts.append(count)
+
+    participants, conversions = counts
+    return (
+        test_id,
+        version,
+        _parse_time(data, "hour"),
+        participants,
+        conversions,
+        parse_idempotency_key(data.get("key")),
+    )
+
+
+class StatsBatch:
+    """
+    Collects participant and conversion increments so they can be written to the database together.
+
+    Increments for the same A/B test, version and hour are summed up, then
+    all of them are written with a single query when the batch is applied.
+    """
+
+    def __init__(self):
+        # Maps (ab_test_id, version, date, hour) tuples to [participants, conversions]
+        self.deltas = defaultdict(lambda: [0, 0])
+
+    def __len__(self):
+        return len(self.deltas)
+
+    def merge(self, other):
+        """
+        Adds all of the increments in another batch to this one.
+        """
+        for key, (participants, conversions) in other.deltas.items():
+            delta = self.deltas[key]
+            delta[0] += participants
+            delta[1] += conversions
+
+    def add(self, ab_test_id, version, participants=0, conversions=0, *, time=None):
+        """
+        Adds participants and/or conversions to the given version of an A/B test.
+        """
+        time = time.astimezone(tz.utc) if time else datetime.now(tz.utc)
+
+        delta = self.deltas[(ab_test_id, version, time.date(), time.hour)]
+        delta[0] += participants
+        delta[1] += conversions
+
+    def apply(self):
+        """
+        Writes the batch to the database and finishes any A/B tests that have now reached their sample size.
+        """
+        AbTestHourlyLog._bulk_increment_stats(
+            {key: tuple(delta) for key, delta in self.deltas.items()}
+        )
+
+        finish_tests_that_reached_sample_size(
+            {
+                ab_test_id
+                for (ab_test_id, version, date, hour), (
+                    participants,
+                    conversions,
+                ) in self.deltas.items()
+                if participants
+            }
+        )
+
+        self.deltas.clear()
+
+
+def finish_tests_that_reached_sample_size(ab_test_ids):
+    """
+    Finishes any of the given running A/B tests that have reached their sample size.
+    """
+    if not ab_test_ids:
+        return
+
+    ab_tests = (
+        AbTest.objects.filter(id__in=ab_test_ids, status=AbTest.STATUS_RUNNING)
+        .alias(
+            total_participants=Sum(
+                F("totals__control_participants") + F("totals__variant_participants")
+            )
+        )
+        .filter(total_participants__gte=F("sample_size"))
+    )
+
+    for ab_test in ab_tests:
+        ab_test.finish()
+
+
+class WriteBehindBuffer:
+    """
+    Coalesces participant and conversion increments in memory before writing them to the database.
+
+    This is enabled by setting WAGTAIL_AB_TESTING_WRITE_BEHIND_INTERVAL to a
+    number of seconds. The buffer is written every time that interval passes,
+    whenever it holds WAGTAIL_AB_TESTING_WRITE_BEHIND_MAX_EVENTS events, and
+    when the process exits. Anything that is in the buffer when a process is
+    killed without being allowed to exit cleanly is lost.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._batch = StatsBatch()
+        self._events = 0
+        self._thread = None
+
+    def get_interval(self):
+        return getattr(settings, "WAGTAIL_AB_TESTING_WRITE_BEHIND_INTERVAL", None)
+
+    def is_enabled(self):
+        return bool(self.get_interval())
+
+    def _get_max_events(self):
+        return getattr(settings, "WAGTAIL_AB_TESTING_WRITE_BEHIND_MAX_EVENTS", 1000)
+
+    def _start_thread(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            time.sleep(self.get_interval() or 1)
+
+            try:
+                self.flush()
+            except Exception:
+                # Nothing would restart this thread, so it must never die
+                logger.exception("Failed to flush buffered A/B testing statistics")
+            finally:
+                # This thread has its own database connection
+                close_old_connections()
+
+    def _add(self, batch, events):
+        # Returns True if the buffer is now full and needs to be flushed
+        with self._lock:
+            if self._thread is None:
+                self._start_thread()
+
+            self._batch.merge(batch)
+            self._events += events
+            return self._events >= self._get_max_events()
+
+    def add(self, batch, events):
+        """
+        Adds a batch of increments, made up of the given number of events, to the buffer.
+        """
+        if self._add(batch, events):
+            self.flush()
+
+    async def aadd(self, batch, events):
+        """
+        Asynchronous version of add(). This only leaves the event loop if the buffer needs to be written.
+        """
+        if self._add(batch, events):
+            await sync_to_async(self.flush)()
+
+    def flush(self):
+        """
+        Writes everything in the buffer to the database.
+        """
+        with self._lock:
+            batch = self._batch
+            self._batch = StatsBatch()
+            self._events = 0
+
+        if not batch:
+            return
+
+        try:
+            batch.apply()
+        except DatabaseError:
+            logger.exception(
+                "Failed to write buffered A/B testing statistics, %d hourly logs were lost",
+                len(batch),
+            )
+        except Exception:
+            # The statistics may have been written, but finishing a test that reached its sample size failed
+            logger.exception(
+                "Failed to apply buffered A/B testing statistics for %d hourly logs",
+                len(batch),
+            )
+
+
+write_behind = WriteBehindBuffer()
+
+
+class IdempotencyKeyStore:
+    """
+    Remembers the idempotency keys of recent events so that retried events can be dropped.
+
+    This is enabled by setting WAGTAIL_AB_TESTING_IDEMPOTENCY_KEY_TIMEOUT to
+    the number of seconds that keys are remembered for. Keys are hashed and
+    kept in the cache set by WAGTAIL_AB_TESTING_CACHE, so they're shared
+    between processes and the memory they use is bounded by the timeout and
+    the cache's own limits.
+
+    Keys are scoped to the A/B test and the kind of event, and each one is
+    claimed with an atomic cache.add(), so two requests with the same key
+    can't both be recorded. If recording the events fails, their keys are
+    released so that the events can be retried. When write-behind is
+    enabled, the keys are kept once the events are in the buffer.
+    """
+
+    def get_timeout(self):
+        return getattr(settings, "WAGTAIL_AB_TESTING_IDEMPOTENCY_KEY_TIMEOUT", None)
+
+    def is_enabled(self):
+        return bool(self.get_timeout())
+
+    def _get_cache_key(self, item, kind):
+        test_id, key = item[0], item[-1]
+        value = f"{test_id}:{kind or item[2]}:{key}"
+        return (
+            "wagtail-ab-testing:idempotency-key:"
+            + hashlib.sha256(value.encode("utf-8")).hexdigest()
+        )
+
+    def _claim(self, items, kind):
+        # Yields the cache operations for claim() and aclaim(), see run_cache_operations()
+        items_to_keep = []
+        claimed_cache_keys = []
+
+        for item in items:
+            if item[-1] is None:
+                items_to_keep.append(item)
+                continue
+
+            cache_key = self._get_cache_key(item, kind)
+            if (yield "add", cache_key, True, self.get_timeout()):
+                items_to_keep.append(item)
+                claimed_cache_keys.append(cache_key)
+
+        return items_to_keep, claimed_cache_keys
+
+    @contextmanager
+    def claim(self, items, kind=None):
+        """
+        Claims the idempotency keys of the given items, and returns the items whose keys hadn't been claimed before.
+
+        Each item is a tuple from parse_event() or parse_delta(), which have
+        their A/B test ID as the first element and their key, or None, as the
+        last. Items without a key are always kept. The kind of event is read
+        from the items from parse_event(), otherwise it must be given.
+
+        This is a context manager that should wrap recording the items. If
+        that raises an exception, the keys are released again.
+        """
+        if not self.is_enabled():
+            yield items
+            return
+
+        items_to_keep, claimed_cache_keys = run_cache_operations(
+            self._claim(items, kind)
+        )
+
+        try:
+            yield items_to_keep
+        except Exception:
+            get_cache().delete_many(claimed_cache_keys)
+            raise
+
+    @asynccontextmanager
+    async def aclaim(self, items, kind=None):
+        """
+        Asynchronous version of claim().
+        """
+        if not self.is_enabled():
+            yield items
+            return
+
+        items_to_keep, claimed_cache_keys = await arun_cache_operations(
+            self._claim(items, kind)
+        )
+
+        try:
+            yield items_to_keep
+        except Exception:
+            await get_cache().adelete_many(claimed_cache_keys)
+            raise
+
+
+idempotency_keys = IdempotencyKeyStore()
+
+
+def _count_participants(batch):
+    for (ab_test_id, version, date, hour), (
+        participants,
+        conversions,
+    ) in batch.deltas.items():
+        if participants:
+            participant_counts.increment(ab_test_id, version, participants)
+
+
+def apply_batch(batch):
+    """
+    Writes a batch of increments to the database straight away, even if write-behind is enabled.
+    """
+    _count_participants(batch)
+    batch.apply()
+
+
+def record_batch(batch, events):
+    """
+    Records a batch of increments that was made up of the given number of events.
+
+    If write-behind is enabled, the batch is coalesced with others in memory.
+    Otherwise, it's written to the database straight away.
+    """
+    if write_behind.is_enabled():
+        _count_participants(batch)
+        write_behind.add(batch, events)
+    else:
+        apply_batch(batch)
+
+
+async def arecord_batch(batch, events):
+    """
+    Asynchronous version of record_batch().
+    """
+    _count_participants(batch)
+
+    if write_behind.is_enabled():
+        await write_behind.aadd(batch, events)
+    else:
+        # The upsert uses a raw database cursor, which Django only provides synchronously
+        await sync_to_async(batch.apply)()
+
+
+def record_stats(ab_test_id, version, participants=0, conversions=0, *, time=None):
+    """
+    Records participants and/or conversions for the given version of an A/B test.
+    """
+    batch = StatsBatch()
+    batch.add(ab_test_id, version, participants, conversions, time=time)
+    record_batch(batch, participants + conversions)
+
+
+async def arecord_stats(
+    ab_test_id, version, participants=0, conversions=0, *, time=None
+):
+    """
+    Asynchronous version of record_stats().
+    """
+    batch = StatsBatch()
+    batch.add(ab_test_id, version, participants, conversions, time=time)
+    await arecord_batch(batch, participants + conversions)
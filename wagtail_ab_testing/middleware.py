@@ -0,0 +1,33 @@
+from .cookies import update_conversions_cookie
+from .events import record_event
+
+
+class ConversionMiddleware:
+    """
+    Records conversions on the server and remembers them in the visitor's cookies.
+
+    Conversions for "visit-page" goals are recorded as the goal pages are
+    served to GET requests from visitors, which counts visitors that block
+    JavaScript and saves the tracker a request. Goal pages are looked up from the in-memory registry of running
+    tests, so other pages don't cost anything.
+
+    The tests that were converted, either here or with record_event(), are
+    saved in a cookie so neither the server nor the tracker counts them again.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+
+        # This is set by the before_serve_page hook for trackable GET requests that aren't from a worker
+        page = getattr(request, "wagtail_ab_testing_page", None)
+        if page is not None and response.status_code == 200:
+            record_event(request, "visit-page", page)
+
+        # Only set if something read or recorded conversions during the request
+        if hasattr(request, "_wagtail_ab_testing_converted_test_ids"):
+            update_conversions_cookie(request, response)
+
+        return response
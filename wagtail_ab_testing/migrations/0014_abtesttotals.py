@@ -0,0 +1,69 @@
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Q, Sum
+
+
+def populate_totals(apps, schema_editor):
+    AbTestHourlyLog = apps.get_model("wagtail_ab_testing.AbTestHourlyLog")
+    AbTestTotals = apps.get_model("wagtail_ab_testing.AbTestTotals")
+
+    AbTestTotals.objects.bulk_create(
+        [
+            AbTestTotals(
+                ab_test_id=stats["ab_test_id"],
+                shard=0,
+                control_participants=stats["control_participants"] or 0,
+                control_conversions=stats["control_conversions"] or 0,
+                variant_participants=stats["variant_participants"] or 0,
+                variant_conversions=stats["variant_conversions"] or 0,
+            )
+            for stats in AbTestHourlyLog.objects.values("ab_test_id")
+            .order_by()
+            .annotate(
+                control_participants=Sum("participants", filter=Q(version="control")),
+                control_conversions=Sum("conversions", filter=Q(version="control")),
+                variant_participants=Sum("participants", filter=Q(version="variant")),
+                variant_conversions=Sum("conversions", filter=Q(version="variant")),
+            )
+        ]
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("wagtail_ab_testing", "0013_alter_abtest_variant_revision"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="AbTestTotals",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("shard", models.PositiveSmallIntegerField(default=0)),
+                ("control_participants", models.PositiveIntegerField(default=0)),
+                ("control_conversions", models.PositiveIntegerField(default=0)),
+                ("variant_participants", models.PositiveIntegerField(default=0)),
+                ("variant_conversions", models.PositiveIntegerField(default=0)),
+                (
+                    "ab_test",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="totals",
+                        to="wagtail_ab_testing.abtest",
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("ab_test", "shard")},
+            },
+        ),
+        migrations.RunPython(populate_totals, migrations.RunPython.noop),
+    ]
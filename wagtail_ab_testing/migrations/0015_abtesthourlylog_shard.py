@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-17 06:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("wagtail_ab_testing", "0014_abtesttotals"),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name="abtesthourlylog",
+            options={"ordering": ["ab_test", "version", "date", "hour", "shard"]},
+        ),
+        migrations.AddField(
+            model_name="abtesthourlylog",
+            name="shard",
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AlterUniqueTogether(
+            name="abtesthourlylog",
+            unique_together={("ab_test", "version", "date", "hour", "shard")},
+        ),
+    ]
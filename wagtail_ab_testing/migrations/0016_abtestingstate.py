@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-17 07:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("wagtail_ab_testing", "0015_abtesthourlylog_shard"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="AbTestingState",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("generation", models.PositiveBigIntegerField(default=0)),
+            ],
+        ),
+    ]
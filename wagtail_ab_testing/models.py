@@ -1,3 +1,4 @@
+import hashlib
 import random
 from datetime import datetime, timedelta
 from datetime import timezone as tz
@@ -7,14 +8,16 @@ import scipy.stats
 from django.conf import settings
 from django.core.validators import MinValueValidator
 from django.db import connection, models, transaction
-from django.db.models import Q, Sum
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 from django.urls import reverse
 from django.utils import timezone
+from django.utils.functional import cached_property
 from django.utils.translation import gettext as _
 from django.utils.translation import gettext_lazy as __
-from wagtail.signals import page_unpublished
+from wagtail.signals import page_published, page_unpublished
 
+from .cache import bump_generation, participant_counts, running_tests
 from .events import get_event_types
 
 
@@ -110,8 +113,45 @@ class AbTest(models.Model):
     previous_run_duration = models.DurationField(default=timedelta(0))
     current_run_started_at = models.DateTimeField(null=True)
 
+    # The fields of AbTestTotals, in the order that totals tuples are given in
+    TOTAL_FIELDS = [
+        "control_participants",
+        "control_conversions",
+        "variant_participants",
+        "variant_conversions",
+    ]
+
     objects = AbTestManager()
 
+    @cached_property
+    def _totals(self):
+        if self.pk is None:
+            return (0, 0, 0, 0)
+
+        return AbTestTotals._get_totals([self.pk]).get(self.pk, (0, 0, 0, 0))
+
+    @property
+    def control_participants(self):
+        return self._totals[0]
+
+    @property
+    def control_conversions(self):
+        return self._totals[1]
+
+    @property
+    def variant_participants(self):
+        return self._totals[2]
+
+    @property
+    def variant_conversions(self):
+        return self._totals[3]
+
+    def refresh_from_db(self, *args, **kwargs):
+        super().refresh_from_db(*args, **kwargs)
+
+        # Read the totals again the next time they're needed
+        self.__dict__.pop("_totals", None)
+
     def get_goal_event_display(self):
         """
         Returns the display name of the goal event.
@@ -203,11 +243,43 @@ class AbTest(models.Model):
         the user decides on the outcome of the test (keep the control or
         publish the variant). This decision is set using the .complete()
         method.
+
+        Returns False without doing anything if the test has already ended,
+        for example because another request finished it at the same time.
         """
-        self.status = self.STATUS_FINISHED
-        self.winning_version = self.check_for_winner()
+        with transaction.atomic():
+            # Change the status with a conditional update so that, when several
+            # requests take the test over its sample size at once, only one of
+            # them goes on to work out the winner
+            finished = (
+                AbTest.objects.filter(
+                    id=self.id,
+                    status__in=[
+                        self.STATUS_DRAFT,
+                        self.STATUS_RUNNING,
+                        self.STATUS_PAUSED,
+                    ],
+                ).update(status=self.STATUS_FINISHED)
+                > 0
+            )
+
+            if not finished:
+                return False
+
+            self.status = self.STATUS_FINISHED
 
-        self.save(update_fields=["status", "winning_version"])
+            # Make sure the winner is worked out from the final totals
+            self.__dict__.pop("_totals", None)
+            self.winning_version = self.check_for_winner()
+
+            AbTest.objects.filter(id=self.id).update(
+                winning_version=self.winning_version
+            )
+
+        # Updating a queryset doesn't send the post_save signal
+        invalidate_cached_state()
+
+        return True
 
     @transaction.atomic
     def complete(self, action, user=None):
@@ -244,19 +316,10 @@ class AbTest(models.Model):
     def get_participation_numbers(self):
         """
         Returns a 2-tuple containing the number of participants who were given the control or variant version of the page respectively.
-        """
-        stats = self.hourly_logs.aggregate(
-            control_participants=Sum(
-                "participants", filter=Q(version=self.VERSION_CONTROL)
-            ),
-            variant_participants=Sum(
-                "participants", filter=Q(version=self.VERSION_VARIANT)
-            ),
-        )
-        control_participants = stats["control_participants"] or 0
-        variant_participants = stats["variant_participants"] or 0
 
-        return control_participants, variant_participants
+        These are the totals as of when they were first read from this instance or last updated by AbTestHourlyLog._increment_stats().
+        """
+        return self.control_participants, self.variant_participants
 
     def get_new_participant_version(self, participation_numbers=None):
         """
@@ -282,29 +345,41 @@ class AbTest(models.Model):
                 ]
             )
 
+    def get_version_for_visitor(self, visitor_id):
+        """
+        Returns the version of the page to display to the visitor with the given stable ID.
+
+        The version is decided by the first byte of the SHA-256 hash of
+        "<salt>:<test id>:<visitor id>", so visitors always get the same one
+        and the split is balanced without looking at participant counts.
+        Edge workers can make the same calculation.
+        """
+        salt = getattr(settings, "WAGTAIL_AB_TESTING_ASSIGNMENT_SALT", "")
+        digest = hashlib.sha256(f"{salt}:{self.id}:{visitor_id}".encode()).digest()
+
+        if digest[0] < 128:
+            return self.VERSION_CONTROL
+
+        return self.VERSION_VARIANT
+
     def add_participant(self, version=None):
         """
         Inserts a new participant into the log. Returns the version that they should be shown.
         """
-        # Get current numbers of participants for each version
-        control_participants, variant_participants = self.get_participation_numbers()
-
         # Create an equal number of participants for each version
         if version is None:
-            # Note, pass participation numbers we already have to save a database query
-            version = self.get_new_participant_version(
-                participation_numbers=(control_participants, variant_participants)
-            )
+            version = self.get_new_participant_version()
 
         # Add new participant to statistics model
+        # This also updates the totals on this instance to include the new participant
         AbTestHourlyLog._increment_stats(self, version, 1, 0)
+        participant_counts.increment(self.id, version)
 
         # If we have now reached the required sample size, end the test
         # Note: we don't care too much that the last few participants won't
         # get a chance to turn into conversions. It's unlikely to make a
         # significant difference to the results.
-        # Note: Adding 1 to account for the new participant
-        if control_participants + variant_participants + 1 >= self.sample_size:
+        if self.control_participants + self.variant_participants >= self.sample_size:
             self.finish()
 
         return version
@@ -328,25 +403,10 @@ class AbTest(models.Model):
         https://www.evanmiller.org/ab-testing/chi-squared.html
         https://towardsdatascience.com/a-b-testing-with-chi-squared-test-to-maximize-conversions-and-ctrs-6599271a2c31
         """
-        # Fetch stats from database
-        stats = self.hourly_logs.aggregate(
-            control_participants=Sum(
-                "participants", filter=Q(version=self.VERSION_CONTROL)
-            ),
-            control_conversions=Sum(
-                "conversions", filter=Q(version=self.VERSION_CONTROL)
-            ),
-            variant_participants=Sum(
-                "participants", filter=Q(version=self.VERSION_VARIANT)
-            ),
-            variant_conversions=Sum(
-                "conversions", filter=Q(version=self.VERSION_VARIANT)
-            ),
-        )
-        control_participants = stats["control_participants"] or 0
-        control_conversions = stats["control_conversions"] or 0
-        variant_participants = stats["variant_participants"] or 0
-        variant_conversions = stats["variant_conversions"] or 0
+        control_participants = self.control_participants
+        control_conversions = self.control_conversions
+        variant_participants = self.variant_participants
+        variant_conversions = self.variant_conversions
 
         if not control_conversions and not variant_conversions:
             return
@@ -395,12 +455,7 @@ class AbTest(models.Model):
         status = self.get_status_display()
 
         if self.status == AbTest.STATUS_RUNNING:
-            participants = (
-                self.hourly_logs.aggregate(participants=Sum("participants"))[
-                    "participants"
-                ]
-                or 0
-            )
+            participants = self.control_participants + self.variant_participants
             completeness_percentange = int((participants * 100) / self.sample_size)
             return status + f" ({completeness_percentange}%)"
 
@@ -427,6 +482,10 @@ class AbTestHourlyLog(models.Model):
     # UTC hour. Values range from 0 to 23
     hour = models.PositiveSmallIntegerField()
 
+    # The statistics of each hour may be spread over several records to reduce
+    # contention on busy A/B tests. See WAGTAIL_AB_TESTING_HOURLY_LOG_SHARDS
+    shard = models.PositiveSmallIntegerField(default=0)
+
     # New participants added in this hour
     participants = models.PositiveIntegerField(default=0)
 
@@ -440,73 +499,289 @@ class AbTestHourlyLog(models.Model):
         """
         Increments the participants/conversions statistics for the given ab_test/version.
 
-        This will create a new AbTestHourlyLog record if one doesn't exist for the current hour.
+        This will create a new AbTestHourlyLog record if one doesn't exist for the current hour and shard.
         """
         time = time.astimezone(tz.utc) if time else datetime.now(tz.utc)
-        date = time.date()
-        hour = time.hour
 
-        if connection.vendor == "postgresql":
-            # Use fast, atomic UPSERT query on PostgreSQL
+        totals = cls._bulk_increment_stats(
+            {
+                (ab_test.id, version, time.date(), time.hour): (
+                    participants,
+                    conversions,
+                )
+            }
+        )
+
+        # Keep the totals on the instance in sync with the database
+        if ab_test.id in totals:
+            ab_test._totals = totals[ab_test.id]
+
+    @classmethod
+    def _bulk_increment_stats(cls, deltas):
+        """
+        Increments the participants/conversions statistics of many hourly logs at once.
+
+        Takes a dictionary mapping (ab_test_id, version, date, hour) tuples to
+        (participants, conversions) tuples. Records are created for any hours
+        and shards that don't have one yet.
+
+        The totals of the A/B tests are updated in the same transaction, in
+        the same shards as the hourly logs. Returns a dictionary mapping the
+        IDs of the A/B tests to their new totals, in the format returned by
+        AbTestTotals._get_totals().
+        """
+        if not deltas:
+            return {}
+
+        # Spread the writes over a random shard of each hour so that concurrent
+        # writers to the same A/B test are less likely to wait for each other's row locks.
+        # Always write rows in the same order so that concurrent writers can't deadlock
+        num_shards = cls._get_num_shards()
+        rows = sorted(
+            (
+                (ab_test_id, version, date, hour, random.randrange(num_shards)),
+                (participants, conversions),
+            )
+            for (ab_test_id, version, date, hour), (
+                participants,
+                conversions,
+            ) in deltas.items()
+        )
+
+        # Sum up the changes to the totals of each shard, in the order of AbTest.TOTAL_FIELDS
+        total_deltas = {}
+        for (ab_test_id, version, date, hour, shard), (
+            participants,
+            conversions,
+        ) in rows:
+            total_delta = total_deltas.setdefault((ab_test_id, shard), [0, 0, 0, 0])
+            offset = 0 if version == AbTest.VERSION_CONTROL else 2
+            total_delta[offset] += participants
+            total_delta[offset + 1] += conversions
+
+        with transaction.atomic():
+            cls._upsert(
+                cls,
+                ["ab_test", "version", "date", "hour", "shard"],
+                ["participants", "conversions"],
+                rows,
+            )
+            cls._upsert(
+                AbTestTotals,
+                ["ab_test", "shard"],
+                AbTest.TOTAL_FIELDS,
+                sorted(total_deltas.items()),
+            )
+
+            return AbTestTotals._get_totals(
+                {ab_test_id for ab_test_id, shard in total_deltas}
+            )
+
+    @staticmethod
+    def _get_num_shards():
+        """
+        Returns the number of hourly logs that each version of an A/B test's statistics are spread over for each hour.
+        """
+        return max(getattr(settings, "WAGTAIL_AB_TESTING_HOURLY_LOG_SHARDS", 1), 1)
+
+    @classmethod
+    def _upsert(cls, model, key_fields, value_fields, rows):
+        """
+        Adds the given list of (key, values) pairs to the rows of the model, creating any that don't exist yet.
+
+        The keys and values are tuples with a value for each of key_fields and value_fields respectively.
+        """
+        if cls._database_supports_upsert():
+            # Use fast, atomic UPSERT queries where the database supports them
             # This needs to be done as a raw query because Django's ORM doesn't support atomic UPSERTs
+            # Split the rows into as few queries as the database's limit on query parameters allows
+            params_per_row = len(key_fields) + len(value_fields)
+            max_query_params = connection.features.max_query_params
+            rows_per_query = (
+                max_query_params // params_per_row if max_query_params else len(rows)
+            )
+
             with connection.cursor() as cursor:
-                table_name = connection.ops.quote_name(cls._meta.db_table)
-
-                query = (
-                    """
-                    INSERT INTO %s (ab_test_id, version, date, hour, participants, conversions)
-                    VALUES (%%s, %%s, %%s, %%s, %%s, %%s)
-                    ON CONFLICT (ab_test_id, version, date, hour)
-                        DO UPDATE SET participants = %s.participants + %%s, conversions = %s.conversions + %%s;
-                """  # noqa: UP031 - percent format is fine here
-                    % (
-                        table_name,
-                        table_name,
-                        table_name,
+                for start in range(0, len(rows), rows_per_query):
+                    chunk = rows[start : start + rows_per_query]
+
+                    cursor.execute(
+                        cls._get_upsert_sql(
+                            model, key_fields, value_fields, len(chunk)
+                        ),
+                        [value for key, values in chunk for value in [*key, *values]],
                     )
-                )
-
-                cursor.execute(
-                    query,
-                    [
-                        ab_test.id,
-                        version,
-                        date,
-                        hour,
-                        participants,
-                        conversions,
-                        participants,
-                        conversions,
-                    ],
-                )
         else:
-            # Fall back to running two queries. This is less efficient.
+            # Fall back to running two queries per row. This is less efficient.
             # We cannot use the simpler update_or_create here
             # because it holds a lock on the row for the duration
             # it takes to run the update query
-            hourly_log, created = cls.objects.get_or_create(
-                ab_test=ab_test,
-                version=version,
-                date=date,
-                hour=hour,
-                defaults={
-                    "participants": participants,
-                    "conversions": conversions,
-                },
+            key_attnames = [
+                model._meta.get_field(field).attname for field in key_fields
+            ]
+
+            for key, values in rows:
+                instance, created = model.objects.get_or_create(
+                    **dict(zip(key_attnames, key)),
+                    defaults=dict(zip(value_fields, values)),
+                )
+
+                if not created:
+                    for field, value in zip(value_fields, values):
+                        setattr(instance, field, models.F(field) + value)
+
+                    instance.save(update_fields=value_fields)
+
+    @staticmethod
+    def _database_supports_upsert():
+        """
+        Returns True if _get_upsert_sql() supports the database that is in use.
+        """
+        if connection.vendor in ["postgresql", "mysql"]:
+            return True
+
+        if connection.vendor == "sqlite":
+            # UPSERT was added in SQLite 3.24
+            return connection.Database.sqlite_version_info >= (3, 24, 0)
+
+        return False
+
+    @staticmethod
+    def _get_upsert_sql(model, key_fields, value_fields, num_rows):
+        """
+        Returns an INSERT query for the given number of rows of the model that adds to the existing values of any rows that already exist.
+
+        Each row takes a parameter for each of the key fields followed by each of the value fields.
+        The key fields must make up a unique constraint of the model.
+        """
+        qn = connection.ops.quote_name
+        table_name = qn(model._meta.db_table)
+        key_columns = [qn(model._meta.get_field(field).column) for field in key_fields]
+        value_columns = [
+            qn(model._meta.get_field(field).column) for field in value_fields
+        ]
+        columns = ", ".join(key_columns + value_columns)
+        placeholders = ", ".join(["%s"] * (len(key_columns) + len(value_columns)))
+        values = ", ".join([f"({placeholders})"] * num_rows)
+
+        if connection.vendor == "mysql":
+            if not connection.mysql_is_mariadb and connection.mysql_version >= (
+                8,
+                0,
+                19,
+            ):
+                # Refer to the new values through a row alias, because the VALUES()
+                # function is deprecated since MySQL 8.0.20
+                alias = qn("excluded")
+                updates = ", ".join(
+                    f"{column} = {column} + {alias}.{column}"
+                    for column in value_columns
+                )
+                return (
+                    f"INSERT INTO {table_name} ({columns}) VALUES {values} AS {alias} "
+                    f"ON DUPLICATE KEY UPDATE {updates}"
+                )
+
+            # MariaDB and older versions of MySQL don't support row aliases
+            updates = ", ".join(
+                f"{column} = {column} + VALUES({column})" for column in value_columns
             )
+            return (
+                f"INSERT INTO {table_name} ({columns}) VALUES {values} "
+                f"ON DUPLICATE KEY UPDATE {updates}"
+            )
+
+        # PostgreSQL and SQLite
+        updates = ", ".join(
+            f"{column} = {table_name}.{column} + EXCLUDED.{column}"
+            for column in value_columns
+        )
+        return (
+            f"INSERT INTO {table_name} ({columns}) VALUES {values} "
+            f"ON CONFLICT ({', '.join(key_columns)}) DO UPDATE SET {updates}"
+        )
+
+    class Meta:
+        ordering = ["ab_test", "version", "date", "hour", "shard"]
+        unique_together = [
+            ("ab_test", "version", "date", "hour", "shard"),
+        ]
 
-            if not created:
-                hourly_log.participants = models.F("participants") + participants
-                hourly_log.conversions = models.F("conversions") + conversions
-                hourly_log.save(update_fields=["participants", "conversions"])
+
+class AbTestTotals(models.Model):
+    """
+    The participant and conversion totals of all of an A/B test's hourly logs.
+
+    These are kept up to date by AbTestHourlyLog._bulk_increment_stats() so
+    they can be read without aggregating the logs. Like the hourly logs, the
+    totals are spread over shards, so each write only locks the row of the
+    shard that the hourly log was written to.
+    """
+
+    ab_test = models.ForeignKey(AbTest, on_delete=models.CASCADE, related_name="totals")
+    shard = models.PositiveSmallIntegerField(default=0)
+
+    control_participants = models.PositiveIntegerField(default=0)
+    control_conversions = models.PositiveIntegerField(default=0)
+    variant_participants = models.PositiveIntegerField(default=0)
+    variant_conversions = models.PositiveIntegerField(default=0)
+
+    @classmethod
+    def _get_totals(cls, ab_test_ids):
+        """
+        Returns a dictionary mapping the given A/B test IDs to (control_participants,
+        control_conversions, variant_participants, variant_conversions) tuples.
+
+        A/B tests that don't have any totals yet are left out.
+        """
+        return {
+            ab_test_id: tuple(totals)
+            for ab_test_id, *totals in cls.objects.filter(ab_test_id__in=ab_test_ids)
+            .values("ab_test_id")
+            .order_by()
+            .annotate(*(models.Sum(field) for field in AbTest.TOTAL_FIELDS))
+            .values_list(
+                "ab_test_id", *(f"{field}__sum" for field in AbTest.TOTAL_FIELDS)
+            )
+        }
 
     class Meta:
-        ordering = ["ab_test", "version", "date", "hour"]
         unique_together = [
-            ("ab_test", "version", "date", "hour"),
+            ("ab_test", "shard"),
         ]
 
 
+class AbTestingState(models.Model):
+    """
+    A single row that holds the generation of the A/B test state.
+
+    Each process keeps copies of the state of the A/B tests in memory, and
+    reloads them when this changes. It's kept in the database so that every
+    process sees changes, whichever cache backend is configured.
+    """
+
+    generation = models.PositiveBigIntegerField(default=0)
+
+
+@receiver(post_save, sender=AbTest)
+@receiver(post_delete, sender=AbTest)
+def invalidate_cached_state(**kwargs):
+    bump_generation()
+
+    # Other threads may have reloaded their cached state from the database
+    # before this change was committed, so invalidate again after the commit
+    transaction.on_commit(bump_generation)
+
+
+@receiver(page_published)
+def invalidate_cached_state_on_page_publish(instance, **kwargs):
+    # Cached variant pages and rendered responses of a test contain content from the live page
+    # Bump the generation once the new revision is committed, otherwise other
+    # threads could cache the old content again before they can see it
+    if running_tests.get_for_page(instance.id) is not None:
+        transaction.on_commit(bump_generation)
+
+
 @receiver(page_unpublished)
 def cancel_on_page_unpublish(instance, **kwargs):
     for ab_test in AbTest.objects.filter(
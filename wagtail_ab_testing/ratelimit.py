@@ -0,0 +1,136 @@
+import math
+import time
+
+from django.conf import settings
+
+from .cache import arun_cache_operations, get_cache, run_cache_operations
+
+
+class RateLimiter:
+    """
+    Limits the rate of tracking events with counters that are stored in the Django cache.
+
+    The limit is read from a setting as a (capacity, period) tuple, which
+    allows up to `capacity` events in any `period` seconds. Events are counted
+    in consecutive windows of `period` seconds. The count of the previous
+    window is weighted by how much of it is still within the last `period`
+    seconds, so bursts around the start of a window are limited as well.
+
+    Counters are only changed with the cache's add() and incr() operations.
+    Each request counts its events before checking the limit, and takes them
+    back off if it's over, so on caches where incr() is atomic (such as Redis
+    and Memcached) concurrent requests can't both take the last of the capacity.
+
+    The number of events that were dropped is counted in the cache as well.
+    """
+
+    def __init__(self, scope, setting_name):
+        self.scope = scope
+        self.setting_name = setting_name
+
+    def get_limit(self):
+        return getattr(settings, self.setting_name, None)
+
+    def is_enabled(self):
+        return self.get_limit() is not None
+
+    def _get_key(self, identifier, window):
+        return f"wagtail-ab-testing:rate-limit:{self.scope}:{identifier}:{window}"
+
+    def _get_dropped_key(self):
+        return f"wagtail-ab-testing:rate-limit-dropped:{self.scope}"
+
+    def _get_windows(self, identifier):
+        # Returns the keys of the current and previous windows, and how much the previous one counts
+        capacity, period = self.get_limit()
+        window, elapsed = divmod(time.time(), period)
+
+        return (
+            self._get_key(identifier, int(window)),
+            self._get_key(identifier, int(window) - 1),
+            1 - elapsed / period,
+        )
+
+    def _get_timeout(self):
+        # Each window is read until the end of the next one
+        capacity, period = self.get_limit()
+        return math.ceil(period * 2)
+
+    def _is_over_limit(self, count, previous_count, previous_weight):
+        capacity, period = self.get_limit()
+        return count + previous_count * previous_weight > capacity
+
+    def _allow(self, identifier, events):
+        # Yields the cache operations for allow() and aallow(), see run_cache_operations()
+        key, previous_key, previous_weight = self._get_windows(identifier)
+        yield "add", key, 0, self._get_timeout()
+
+        try:
+            count = yield "incr", key, events
+        except ValueError:
+            # The counter expired in the meantime, so this is the start of a new window
+            return True
+
+        previous_count = yield "get", previous_key, 0
+        if not self._is_over_limit(count, previous_count, previous_weight):
+            return True
+
+        # Dropped events don't count towards the limit
+        try:
+            yield "decr", key, events
+        except ValueError:
+            pass
+
+        yield "add", self._get_dropped_key(), 0, None
+        try:
+            yield "incr", self._get_dropped_key(), events
+        except ValueError:
+            # The counter was deleted in the meantime
+            pass
+
+        return False
+
+    def allow(self, identifier, events=1):
+        """
+        Returns True if the given number of events are allowed for the identifier, and counts them towards its limit.
+
+        Always returns True if the limit isn't configured.
+        """
+        if not self.is_enabled():
+            return True
+
+        return run_cache_operations(self._allow(identifier, events))
+
+    async def aallow(self, identifier, events=1):
+        """
+        Asynchronous version of allow().
+        """
+        if not self.is_enabled():
+            return True
+
+        return await arun_cache_operations(self._allow(identifier, events))
+
+    def get_dropped_count(self):
+        """
+        Returns the number of events that have been dropped by this limiter in all processes.
+        """
+        return get_cache().get(self._get_dropped_key(), 0)
+
+    def reset_dropped_count(self):
+        get_cache().delete(self._get_dropped_key())
+
+
+# Limits the events that each client IP address can send
+ip_rate_limiter = RateLimiter("ip", "WAGTAIL_AB_TESTING_RATE_LIMIT_PER_IP")
+
+# Limits the events that can be recorded for each A/B test across all clients
+test_rate_limiter = RateLimiter("test", "WAGTAIL_AB_TESTING_RATE_LIMIT_PER_TEST")
+
+
+def get_client_ip(request):
+    """
+    Returns the IP address that rate limits are applied to for the given request.
+
+    Sites that are behind a proxy should make sure that REMOTE_ADDR is set to the address of the client.
+    """
+    return request.META.get("REMOTE_ADDR", "")
@@ -38,82 +38,170 @@
         return '';
     }
 
-    // Does the current page have an A/B test running?
-    if (window.wagtailAbTesting) {
-        // Register the user as a participant if they haven't registered yet
-        if (window.wagtailAbTesting.testId) {
-            // Fetch the goal info from local storage
-            // This data structure looks like:
-            // {
-            //   <id of goal page> : {
-            //     <goal event>: [<ids of tests with this goal page/eveqnt>]
-            //   }
-            // }
-            var goals = window.localStorage.getItem('abtesting-goals');
-            if (goals) {
-                goals = JSON.parse(goals);
-            } else {
-                goals = {};
-            }
+    // The versions of all the tests the user is participating in are kept in
+    // one cookie that looks like "12:c|15:v"
+    var assignmentsCookieName = 'wagtail-ab-testing';
+    var versionCodes = { control: 'c', variant: 'v' };
+    var versionsByCode = { c: 'control', v: 'variant' };
 
-            // Add this goal page/event into the goals data structure
-            goals[window.wagtailAbTesting.goalPageId] =
-                goals[window.wagtailAbTesting.goalPageId] || {};
-            goals[window.wagtailAbTesting.goalPageId][
-                window.wagtailAbTesting.goalEvent
-            ] =
-                goals[window.wagtailAbTesting.goalPageId][
-                    window.wagtailAbTesting.goalEvent
-                ] || [];
+    function getAssignments() {
+        var assignments = {};
 
-            // Check if this user is already a participant in this test
-            // We could check the cookie instead, but it's possible that the user has cleared their cookies but not local storage
-            if (
-                goals[window.wagtailAbTesting.goalPageId][
-                    window.wagtailAbTesting.goalEvent
-                ].indexOf(window.wagtailAbTesting.testId) === -1
-            ) {
-                var cookieName =
-                    'wagtail-ab-testing_' +
-                    window.wagtailAbTesting.testId +
-                    '_version';
-                if (!document.cookie.includes(cookieName)) {
-                    fetch(window.wagtailAbTesting.urls.registerParticipant, {
-                        method: 'POST',
-                        headers: {
-                            'Content-Type': 'application/json',
-                        },
-                        body: JSON.stringify({
-                            test_id: window.wagtailAbTesting.testId,
-                            version: window.wagtailAbTesting.version,
-                        }),
-                    }).then(function (response) {
-                        if (response.status === 200) {
-                            // Put the version into a cookie so that Wagtail continues to serve this version
-                            var expires = new Date();
-                            expires.setFullYear(expires.getFullYear() + 1);
-                            document.cookie =
-                                cookieName +
-                                '=' +
-                                window.wagtailAbTesting.version +
-                                '; path=/; expires=' +
-                                expires.toUTCString();
-
-                            // Store the test ID against the goal event in the goals data structure
-                            // We will use this for knowing when to call the goal reached API later
-                            goals[window.wagtailAbTesting.goalPageId][
-                                window.wagtailAbTesting.goalEvent
-                            ].push(window.wagtailAbTesting.testId);
-                            window.localStorage.setItem(
-                                'abtesting-goals',
-                                JSON.stringify(goals),
-                            );
-                        }
-                    });
-                }
+        // Older versions of this script set a separate cookie for each test
+        var cookies = document.cookie.split(';');
+        for (var i = 0; i < cookies.length; i++) {
+            var match = cookies[i]
+                .trim()
+                .match(/^wagtail-ab-testing_(\d+)_version=(\w+)$/);
+            if (match) {
+                assignments[match[1]] =
+                    match[2] === 'variant' ? 'variant' : 'control';
             }
         }
 
+        var entries = getCookie(assignmentsCookieName).split('|');
+        for (var j = 0; j < entries.length; j++) {
+            var parts = entries[j].split(':');
+            if (parts.length === 2 && versionsByCode[parts[1]]) {
+                assignments[parts[0]] = versionsByCode[parts[1]];
+            }
+        }
+
+        return assignments;
+    }
+
+    function setAssignment(testId, version) {
+        var assignments = getAssignments();
+        assignments[testId] = version;
+
+        var entries = [];
+        for (var id in assignments) {
+            entries.push(id + ':' + versionCodes[assignments[id]]);
+
+            // Remove the legacy cookie now its assignment is in the new one
+            document.cookie =
+                'wagtail-ab-testing_' +
+                id +
+                '_version=; path=/; expires=Thu, 01 Jan 1970 00:00:00 GMT';
+        }
+
+        var expires = new Date();
+        expires.setFullYear(expires.getFullYear() + 1);
+        document.cookie =
+            assignmentsCookieName +
+            '=' +
+            entries.join('|') +
+            '; path=/; expires=' +
+            expires.toUTCString() +
+            '; SameSite=Lax';
+    }
+
+    // The IDs of tests that the user has reached the goal of are kept in a
+    // cookie, so conversions that the server recorded aren't counted again
+    var conversionsCookieName = 'wagtail-ab-testing-conversions';
+
+    function getConvertedTestIds() {
+        var testIds = getCookie(conversionsCookieName);
+        return testIds ? testIds.split('|') : [];
+    }
+
+    function addConvertedTestId(testId) {
+        var testIds = getConvertedTestIds();
+        testIds.push(testId);
+
+        var expires = new Date();
+        expires.setFullYear(expires.getFullYear() + 1);
+        document.cookie =
+            conversionsCookieName +
+            '=' +
+            testIds.join('|') +
+            '; path=/; expires=' +
+            expires.toUTCString() +
+            '; SameSite=Lax';
+    }
+
+    // Participant and conversion events are queued up and sent to the server
+    // in a single request when the user leaves or hides the page
+    var eventQueue = [];
+
+    function queueEvent(testId, version, kind) {
+        eventQueue.push({
+            test_id: testId,
+            version: version,
+            kind: kind,
+            // Lets the server drop the event if the request is retried
+            key: generateId(),
+        });
+    }
+
+    function flushEvents() {
+        if (!eventQueue.length) {
+            return;
+        }
+
+        var body = JSON.stringify({ events: eventQueue });
+        eventQueue = [];
+
+        // sendBeacon requests are sent even if the page is being unloaded
+        if (
+            navigator.sendBeacon &&
+            navigator.sendBeacon(
+                window.wagtailAbTesting.urls.events,
+                new Blob([body], { type: 'application/json' }),
+            )
+        ) {
+            return;
+        }
+
+        // Fall back to fetch, which also outlives the page with keepalive
+        fetch(window.wagtailAbTesting.urls.events, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            body: body,
+            keepalive: true,
+        });
+    }
+
+    function generateId() {
+        if (window.crypto && window.crypto.randomUUID) {
+            return window.crypto.randomUUID();
+        }
+
+        return (
+            Math.random().toString(36).substring(2) + Date.now().toString(36)
+        );
+    }
+
+    // Give the user a stable ID if hash-based assignment is enabled, so
+    // they're assigned a version from it on the next page they visit
+    if (
+        window.wagtailAbTesting &&
+        window.wagtailAbTesting.visitorIdCookie &&
+        !getCookie(window.wagtailAbTesting.visitorIdCookie)
+    ) {
+        var visitorId = generateId();
+        var visitorIdExpires = new Date();
+        visitorIdExpires.setFullYear(visitorIdExpires.getFullYear() + 1);
+        document.cookie =
+            window.wagtailAbTesting.visitorIdCookie +
+            '=' +
+            visitorId +
+            '; path=/; expires=' +
+            visitorIdExpires.toUTCString() +
+            '; SameSite=Lax';
+    }
+
+    // Does the current page have an A/B test running?
+    if (window.wagtailAbTesting) {
+        document.addEventListener('visibilitychange', function () {
+            if (document.visibilityState === 'hidden') {
+                flushEvents();
+            }
+        });
+        window.addEventListener('pagehide', flushEvents);
+
         window.wagtailAbTesting.triggerEvent = function (event) {
             // Check if any goals were reached
             var goalsJson = window.localStorage.getItem('abtesting-goals');
@@ -133,22 +221,18 @@
                     return;
                 }
 
+                var assignments = getAssignments();
+                var convertedTestIds = getConvertedTestIds();
+
                 goalsForEvent.forEach(function (testId) {
-                    var cookieName =
-                        'wagtail-ab-testing_' + testId + '_version';
-                    var version = getCookie(cookieName);
-
-                    if (version) {
-                        fetch(window.wagtailAbTesting.urls.goalReached, {
-                            method: 'POST',
-                            headers: {
-                                'Content-Type': 'application/json',
-                            },
-                            body: JSON.stringify({
-                                test_id: testId,
-                                version: version,
-                            }),
-                        });
+                    var version = assignments[testId];
+
+                    if (
+                        version &&
+                        convertedTestIds.indexOf(String(testId)) === -1
+                    ) {
+                        queueEvent(testId, version, 'conversion');
+                        addConvertedTestId(testId);
                     }
                 });
 
@@ -173,5 +257,67 @@
 
         // Trigger visit page event
         window.wagtailAbTesting.triggerEvent('visit-page');
+
+        // Register the user as a participant if they haven't registered yet
+        // This is done after triggering the visit page event so that the
+        // participant's goal can't be reached by the page they joined the test on
+        if (window.wagtailAbTesting.testId) {
+            // Fetch the goal info from local storage
+            // This data structure looks like:
+            // {
+            //   <id of goal page> : {
+            //     <goal event>: [<ids of tests with this goal page/eveqnt>]
+            //   }
+            // }
+            var goals = window.localStorage.getItem('abtesting-goals');
+            if (goals) {
+                goals = JSON.parse(goals);
+            } else {
+                goals = {};
+            }
+
+            // Add this goal page/event into the goals data structure
+            goals[window.wagtailAbTesting.goalPageId] =
+                goals[window.wagtailAbTesting.goalPageId] || {};
+            goals[window.wagtailAbTesting.goalPageId][
+                window.wagtailAbTesting.goalEvent
+            ] =
+                goals[window.wagtailAbTesting.goalPageId][
+                    window.wagtailAbTesting.goalEvent
+                ] || [];
+
+            // Check if this user is already a participant in this test
+            // We could check the cookie instead, but it's possible that the user has cleared their cookies but not local storage
+            if (
+                goals[window.wagtailAbTesting.goalPageId][
+                    window.wagtailAbTesting.goalEvent
+                ].indexOf(window.wagtailAbTesting.testId) === -1
+            ) {
+                if (!getAssignments()[window.wagtailAbTesting.testId]) {
+                    queueEvent(
+                        window.wagtailAbTesting.testId,
+                        window.wagtailAbTesting.version,
+                        'participant',
+                    );
+
+                    // Put the version into a cookie so that Wagtail continues to serve this version
+                    // This is done straight away, as the response to the queued event can't be read
+                    setAssignment(
+                        window.wagtailAbTesting.testId,
+                        window.wagtailAbTesting.version,
+                    );
+
+                    // Store the test ID against the goal event in the goals data structure
+                    // We will use this for knowing when to log conversions later
+                    goals[window.wagtailAbTesting.goalPageId][
+                        window.wagtailAbTesting.goalEvent
+                    ].push(window.wagtailAbTesting.testId);
+                    window.localStorage.setItem(
+                        'abtesting-goals',
+                        JSON.stringify(goals),
+                    );
+                }
+            }
+        }
     }
 })();
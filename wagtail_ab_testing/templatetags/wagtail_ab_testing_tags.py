@@ -1,4 +1,5 @@
 from django import template
+from django.conf import settings
 from django.urls import reverse
 
 from wagtail_ab_testing.models import AbTest
@@ -21,14 +22,20 @@ def wagtail_ab_testing_script(context):
 
     register_participant_url = reverse("wagtail_ab_testing:register_participant")
     goal_reached_url = reverse("wagtail_ab_testing:goal_reached")
+    events_url = reverse("wagtail_ab_testing:events")
 
     tracking_parameters = {
         "urls": {
             "registerParticipant": register_participant_url,
             "goalReached": goal_reached_url,
+            "events": events_url,
         },
     }
 
+    visitor_id_cookie = getattr(settings, "WAGTAIL_AB_TESTING_VISITOR_ID_COOKIE", None)
+    if visitor_id_cookie:
+        tracking_parameters["visitorIdCookie"] = visitor_id_cookie
+
     page = context.get("page", None)
     page_id = page.id if page else None
     if page_id:
@@ -41,9 +48,7 @@ def wagtail_ab_testing_script(context):
         tracking_parameters["testId"] = test.id
         tracking_parameters["version"] = version
         tracking_parameters["goalEvent"] = test.goal_event
-        tracking_parameters["goalPageId"] = (
-            test.goal_page.id if test.goal_page else None
-        )
+        tracking_parameters["goalPageId"] = test.goal_page_id
 
     return {
         "track": track,
@@ -0,0 +1,126 @@
+import asyncio
+import json
+import time
+from unittest.mock import patch
+
+from django.core.management.base import BaseCommand
+from django.shortcuts import get_object_or_404
+from django.test import RequestFactory, override_settings
+from django.urls import reverse
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework import status
+from rest_framework.decorators import (
+    api_view,
+    authentication_classes,
+    permission_classes,
+)
+from rest_framework.response import Response
+from wagtail.models import Page
+
+from wagtail_ab_testing.ingest import record_stats, write_behind
+from wagtail_ab_testing.models import AbTest
+from wagtail_ab_testing.views import aregister_participant, register_participant
+
+
+@csrf_exempt
+@api_view(["POST"])
+@authentication_classes([])
+@permission_classes([])
+def drf_register_participant(request):
+    # The Django REST framework implementation that register_participant replaced
+    test_id = request.data.get("test_id", None)
+    if test_id is None:
+        return Response("test_id not provided", status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        test_id = int(test_id)
+        if test_id < 1:
+            raise ValueError
+    except ValueError:
+        return Response(
+            "test_id must be a positive integer", status=status.HTTP_400_BAD_REQUEST
+        )
+
+    test = get_object_or_404(AbTest, id=test_id)
+
+    version = request.data.get("version", None)
+    if version is None:
+        return Response("version not provided", status=status.HTTP_400_BAD_REQUEST)
+
+    if version not in [AbTest.VERSION_CONTROL, AbTest.VERSION_VARIANT]:
+        return Response(
+            f"version must be either '{AbTest.VERSION_CONTROL}' or '{AbTest.VERSION_VARIANT}'",
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+
+    record_stats(test.id, version, participants=1)
+
+    return Response()
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares the time taken to handle requests to the register_participant "
+        "endpoint with the Django REST framework view that it replaced. "
+        "The async view is run in a single event loop, like it would be under ASGI. "
+        "Run the migrate command first."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=5000)
+
+    def handle(self, *args, **options):
+        num_requests = options["requests"]
+
+        page = Page.objects.get(id=2)
+        ab_test = AbTest.objects.create(
+            page=page,
+            name="Benchmark",
+            variant_revision=page.save_revision(),
+            status=AbTest.STATUS_RUNNING,
+            goal_event="visit-page",
+            sample_size=num_requests * 10,
+        )
+
+        factory = RequestFactory()
+        url = reverse("wagtail_ab_testing:register_participant")
+        body = json.dumps({"test_id": ab_test.id, "version": "control"})
+
+        def make_request():
+            return factory.post(url, body, content_type="application/json")
+
+        def run_sync(view):
+            for i in range(num_requests):
+                response = view(make_request())
+                assert response.status_code in [200, 204], response.status_code
+
+        async def run_async():
+            for i in range(num_requests):
+                response = await aregister_participant(make_request())
+                assert response.status_code == 204, response.status_code
+
+        benchmarks = [
+            ("Django REST framework", lambda: run_sync(drf_register_participant)),
+            ("Plain Django", lambda: run_sync(register_participant)),
+            ("Plain Django, async", lambda: asyncio.run(run_async())),
+        ]
+
+        # Buffer the writes in memory so this measures the cost of handling
+        # requests rather than the speed of the database
+        try:
+            with (
+                override_settings(WAGTAIL_AB_TESTING_WRITE_BEHIND_INTERVAL=3600),
+                patch.object(write_behind, "_start_thread"),
+            ):
+                for name, benchmark in benchmarks:
+                    start = time.perf_counter()
+                    benchmark()
+                    elapsed = time.perf_counter() - start
+
+                    self.stdout.write(
+                        f"{name}: {elapsed / num_requests * 1000000:.0f}µs per request"
+                    )
+
+                    write_behind.flush()
+        finally:
+            ab_test.delete()
@@ -1,10 +1,14 @@
 import datetime
+from unittest.mock import patch
 
+from django.db import connection
 from django.db.models.deletion import ProtectedError
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from freezegun import freeze_time
 from wagtail.models import Page
 
+from wagtail_ab_testing.cache import running_tests
 from wagtail_ab_testing.models import AbTest, AbTestHourlyLog
 
 
@@ -27,6 +31,34 @@ class TestAbTestModel(TestCase):
         self.ab_test.refresh_from_db()
         self.assertEqual(self.ab_test.status, AbTest.STATUS_FINISHED)
 
+    def test_finish_only_once(self):
+        # Another request loaded the test before it was finished
+        stale_ab_test = AbTest.objects.get(id=self.ab_test.id)
+
+        self.assertTrue(self.ab_test.finish())
+
+        with patch.object(AbTest, "check_for_winner") as check_for_winner:
+            self.assertFalse(stale_ab_test.finish())
+
+        check_for_winner.assert_not_called()
+
+    def test_finish_invalidates_running_tests(self):
+        self.ab_test.start()
+        self.assertIsNotNone(running_tests.get_for_page(self.ab_test.page_id))
+
+        self.ab_test.finish()
+
+        self.assertIsNone(running_tests.get_for_page(self.ab_test.page_id))
+
+    def test_finish_uses_latest_totals(self):
+        stale_ab_test = AbTest.objects.get(id=self.ab_test.id)
+        self.set_up_test(100, 80, 100, 20)
+
+        stale_ab_test.finish()
+        stale_ab_test.refresh_from_db()
+
+        self.assertEqual(stale_ab_test.winning_version, AbTest.VERSION_CONTROL)
+
     def test_cancel(self):
         self.ab_test.cancel()
         self.ab_test.refresh_from_db()
@@ -37,27 +69,13 @@ class TestAbTestModel(TestCase):
         self.assertEqual(control, 0)
         self.assertEqual(variant, 0)
 
-        AbTestHourlyLog.objects.create(
-            ab_test=self.ab_test,
-            version=AbTest.VERSION_CONTROL,
-            date=datetime.date(2020, 11, 4),
-            hour=22,
-            participants=1,
-            conversions=0,
-        )
+        AbTestHourlyLog._increment_stats(self.ab_test, AbTest.VERSION_CONTROL, 1, 0)
 
         control, variant = self.ab_test.get_participation_numbers()
         self.assertEqual(control, 1)
         self.assertEqual(variant, 0)
 
-        AbTestHourlyLog.objects.create(
-            ab_test=self.ab_test,
-            version=AbTest.VERSION_VARIANT,
-            date=datetime.date(2020, 11, 4),
-            hour=22,
-            participants=1,
-            conversions=0,
-        )
+        AbTestHourlyLog._increment_stats(self.ab_test, AbTest.VERSION_VARIANT, 1, 0)
 
         control, variant = self.ab_test.get_participation_numbers()
         self.assertEqual(control, 1)
@@ -72,6 +90,27 @@ class TestAbTestModel(TestCase):
         version = self.ab_test.get_new_participant_version(participation_numbers=(1, 2))
         self.assertEqual(version, AbTest.VERSION_CONTROL)
 
+    def test_get_version_for_visitor(self):
+        versions = [
+            self.ab_test.get_version_for_visitor(f"visitor-{i}") for i in range(1000)
+        ]
+
+        # The same visitor always gets the same version
+        self.assertEqual(versions[0], self.ab_test.get_version_for_visitor("visitor-0"))
+
+        # Visitors are split roughly evenly
+        self.assertAlmostEqual(versions.count(AbTest.VERSION_CONTROL), 500, delta=60)
+
+        # The salt changes the assignments
+        with override_settings(WAGTAIL_AB_TESTING_ASSIGNMENT_SALT="salt"):
+            self.assertNotEqual(
+                versions,
+                [
+                    self.ab_test.get_version_for_visitor(f"visitor-{i}")
+                    for i in range(1000)
+                ],
+            )
+
     def test_add_participant(self):
         version = self.ab_test.add_participant()
 
@@ -104,6 +143,158 @@ class TestAbTestModel(TestCase):
         self.assertEqual(log.participants, 0)
         self.assertEqual(log.conversions, 2)
 
+    def bulk_increment_stats(self):
+        date = datetime.date(2020, 11, 4)
+        deltas = {
+            (self.ab_test.id, AbTest.VERSION_CONTROL, date, 21): (3, 1),
+            (self.ab_test.id, AbTest.VERSION_CONTROL, date, 22): (2, 0),
+            (self.ab_test.id, AbTest.VERSION_VARIANT, date, 22): (1, 1),
+        }
+
+        with CaptureQueriesContext(connection) as queries:
+            AbTestHourlyLog._bulk_increment_stats(deltas)
+            totals = AbTestHourlyLog._bulk_increment_stats(deltas)
+
+        self.assertEqual(totals, {self.ab_test.id: (10, 2, 2, 2)})
+        self.assertEqual(
+            set(
+                self.ab_test.hourly_logs.values_list(
+                    "version", "hour", "participants", "conversions"
+                )
+            ),
+            {
+                (AbTest.VERSION_CONTROL, 21, 6, 2),
+                (AbTest.VERSION_CONTROL, 22, 4, 0),
+                (AbTest.VERSION_VARIANT, 22, 2, 2),
+            },
+        )
+
+        self.ab_test.refresh_from_db()
+        self.assertEqual(self.ab_test.get_participation_numbers(), (10, 2))
+        self.assertEqual(self.ab_test.control_conversions, 2)
+        self.assertEqual(self.ab_test.variant_conversions, 2)
+
+        return [
+            query["sql"]
+            for query in queries.captured_queries
+            if query["sql"].startswith("INSERT")
+        ]
+
+    def test_bulk_increment_stats(self):
+        # One upsert for the hourly logs and one for the totals per call
+        self.assertEqual(len(self.bulk_increment_stats()), 4)
+
+    def test_bulk_increment_stats_splits_queries(self):
+        # The hourly logs take seven parameters per row and need two queries
+        with patch.object(connection.features, "max_query_params", 14):
+            self.assertEqual(len(self.bulk_increment_stats()), 6)
+
+    def test_bulk_increment_stats_without_upsert(self):
+        with patch.object(
+            AbTestHourlyLog, "_database_supports_upsert", return_value=False
+        ):
+            self.bulk_increment_stats()
+
+    def get_mysql_upsert_sql(self, mysql_version, mysql_is_mariadb=False):
+        with (
+            patch.object(connection, "vendor", "mysql"),
+            patch.object(connection, "mysql_version", mysql_version, create=True),
+            patch.object(connection, "mysql_is_mariadb", mysql_is_mariadb, create=True),
+            patch.object(
+                connection.ops, "quote_name", side_effect=lambda name: f"`{name}`"
+            ),
+        ):
+            return AbTestHourlyLog._get_upsert_sql(
+                AbTestHourlyLog,
+                ["ab_test", "version", "date", "hour", "shard"],
+                ["participants", "conversions"],
+                2,
+            )
+
+    def test_mysql_upsert_sql(self):
+        self.assertEqual(
+            self.get_mysql_upsert_sql((8, 0, 19)),
+            "INSERT INTO `wagtail_ab_testing_abtesthourlylog` "
+            "(`ab_test_id`, `version`, `date`, `hour`, `shard`, `participants`, `conversions`) "
+            "VALUES (%s, %s, %s, %s, %s, %s, %s), (%s, %s, %s, %s, %s, %s, %s) AS `excluded` "
+            "ON DUPLICATE KEY UPDATE "
+            "`participants` = `participants` + `excluded`.`participants`, "
+            "`conversions` = `conversions` + `excluded`.`conversions`",
+        )
+
+    def test_mysql_upsert_sql_without_row_alias(self):
+        expected_sql = (
+            "INSERT INTO `wagtail_ab_testing_abtesthourlylog` "
+            "(`ab_test_id`, `version`, `date`, `hour`, `shard`, `participants`, `conversions`) "
+            "VALUES (%s, %s, %s, %s, %s, %s, %s), (%s, %s, %s, %s, %s, %s, %s) "
+            "ON DUPLICATE KEY UPDATE "
+            "`participants` = `participants` + VALUES(`participants`), "
+            "`conversions` = `conversions` + VALUES(`conversions`)"
+        )
+
+        self.assertEqual(self.get_mysql_upsert_sql((8, 0, 18)), expected_sql)
+        self.assertEqual(
+            self.get_mysql_upsert_sql((11, 4, 2), mysql_is_mariadb=True), expected_sql
+        )
+
+    @override_settings(WAGTAIL_AB_TESTING_HOURLY_LOG_SHARDS=2)
+    def test_increment_stats_sharded(self):
+        with patch("random.randrange", side_effect=[0, 1, 1]) as randrange:
+            for i in range(3):
+                AbTestHourlyLog._increment_stats(
+                    self.ab_test, AbTest.VERSION_CONTROL, 1, 0
+                )
+
+        randrange.assert_called_with(2)
+        self.assertEqual(
+            list(self.ab_test.hourly_logs.values_list("shard", "participants")),
+            [(0, 1), (1, 2)],
+        )
+
+        # The totals are written to the same shards as the hourly logs
+        self.assertEqual(
+            list(
+                self.ab_test.totals.order_by("shard").values_list(
+                    "shard", "control_participants"
+                )
+            ),
+            [(0, 1), (1, 2)],
+        )
+        self.assertEqual(self.ab_test.get_participation_numbers(), (3, 0))
+
+        self.ab_test.refresh_from_db()
+        self.assertEqual(self.ab_test.get_participation_numbers(), (3, 0))
+
+    def test_save_doesnt_overwrite_totals(self):
+        ab_test = AbTest.objects.get(id=self.ab_test.id)
+        AbTestHourlyLog._increment_stats(self.ab_test, AbTest.VERSION_CONTROL, 1, 1)
+
+        ab_test.name = "Changed name"
+        ab_test.save()
+
+        ab_test.refresh_from_db()
+        self.assertEqual(ab_test.name, "Changed name")
+        self.assertEqual(ab_test.control_participants, 1)
+        self.assertEqual(ab_test.control_conversions, 1)
+
+    def test_save_copy(self):
+        AbTestHourlyLog._increment_stats(self.ab_test, AbTest.VERSION_CONTROL, 1, 1)
+        ab_test = AbTest.objects.get(id=self.ab_test.id)
+
+        ab_test.pk = None
+        ab_test.save()
+
+        self.assertNotEqual(ab_test.id, self.ab_test.id)
+        ab_test.refresh_from_db()
+        self.assertEqual(ab_test.name, "Test")
+
+        # The statistics aren't copied
+        self.assertEqual(ab_test.control_participants, 0)
+
+        # The original test is left alone
+        self.ab_test.refresh_from_db()
+        self.assertEqual(self.ab_test.control_participants, 1)
+
     def set_up_test(
         self,
         control_participants,
@@ -111,22 +302,18 @@ class TestAbTestModel(TestCase):
         variant_participants,
         variant_conversions,
     ):
-        AbTestHourlyLog.objects.create(
-            ab_test=self.ab_test,
-            version=AbTest.VERSION_CONTROL,
-            date=datetime.date(2020, 11, 4),
-            hour=22,
-            participants=control_participants,
-            conversions=control_conversions,
+        AbTestHourlyLog._increment_stats(
+            self.ab_test,
+            AbTest.VERSION_CONTROL,
+            control_participants,
+            control_conversions,
         )
 
-        AbTestHourlyLog.objects.create(
-            ab_test=self.ab_test,
-            version=AbTest.VERSION_VARIANT,
-            date=datetime.date(2020, 11, 4),
-            hour=22,
-            participants=variant_participants,
-            conversions=variant_conversions,
+        AbTestHourlyLog._increment_stats(
+            self.ab_test,
+            AbTest.VERSION_VARIANT,
+            variant_participants,
+            variant_conversions,
         )
 
     def test_check_for_winner_no_data(self):
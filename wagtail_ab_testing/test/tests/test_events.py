@@ -0,0 +1,89 @@
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase
+from wagtail.models import Page
+
+from wagtail_ab_testing.events import record_event
+from wagtail_ab_testing.middleware import ConversionMiddleware
+from wagtail_ab_testing.models import AbTest
+
+
+class TestRecordEvent(TestCase):
+    def setUp(self):
+        self.home_page = Page.objects.get(id=2)
+        self.goal_page = self.home_page.add_child(
+            instance=Page(title="Goal", slug="goal")
+        )
+        self.ab_test = AbTest.objects.create(
+            page=self.home_page,
+            name="Test",
+            variant_revision=self.home_page.save_revision(),
+            goal_event="purchase",
+            goal_page=self.goal_page,
+            sample_size=10,
+            status=AbTest.STATUS_RUNNING,
+        )
+
+    def get_request(self, assignments=None, conversions=None):
+        request = RequestFactory().post("/")
+        if assignments is not None:
+            request.COOKIES["wagtail-ab-testing"] = assignments
+        if conversions is not None:
+            request.COOKIES["wagtail-ab-testing-conversions"] = conversions
+        return request
+
+    def test_record_event(self):
+        request = self.get_request(f"{self.ab_test.id}:v")
+
+        self.assertEqual(
+            record_event(request, "purchase", self.goal_page), [self.ab_test.id]
+        )
+
+        log = self.ab_test.hourly_logs.get()
+        self.assertEqual(log.version, AbTest.VERSION_VARIANT)
+        self.assertEqual(log.conversions, 1)
+
+        # The conversion is only recorded once per request
+        self.assertEqual(record_event(request, "purchase", self.goal_page), [])
+        self.assertEqual(self.ab_test.hourly_logs.get().conversions, 1)
+
+    def test_global_goal(self):
+        self.ab_test.goal_page = None
+        self.ab_test.save()
+
+        request = self.get_request(f"{self.ab_test.id}:c")
+
+        self.assertEqual(record_event(request, "purchase"), [self.ab_test.id])
+        self.assertEqual(self.ab_test.hourly_logs.get().version, AbTest.VERSION_CONTROL)
+
+    def test_other_page_or_event(self):
+        request = self.get_request(f"{self.ab_test.id}:v")
+
+        self.assertEqual(record_event(request, "purchase", self.home_page), [])
+        self.assertEqual(record_event(request, "purchase"), [])
+        self.assertEqual(record_event(request, "visit-page", self.goal_page), [])
+        self.assertFalse(self.ab_test.hourly_logs.exists())
+
+    def test_not_participating(self):
+        request = self.get_request()
+
+        self.assertEqual(record_event(request, "purchase", self.goal_page), [])
+        self.assertFalse(self.ab_test.hourly_logs.exists())
+
+    def test_already_converted(self):
+        request = self.get_request(f"{self.ab_test.id}:v", str(self.ab_test.id))
+
+        self.assertEqual(record_event(request, "purchase", self.goal_page), [])
+        self.assertFalse(self.ab_test.hourly_logs.exists())
+
+    def test_middleware_saves_conversions(self):
+        def view(request):
+            record_event(request, "purchase", self.goal_page)
+            return HttpResponse()
+
+        request = self.get_request(f"{self.ab_test.id}:v")
+        response = ConversionMiddleware(view)(request)
+
+        self.assertEqual(
+            response.cookies["wagtail-ab-testing-conversions"].value,
+            str(self.ab_test.id),
+        )
@@ -0,0 +1,320 @@
+import datetime
+from unittest.mock import patch
+
+from asgiref.sync import sync_to_async
+from django.db import DatabaseError
+from django.test import AsyncRequestFactory, TestCase, override_settings
+from django.urls import reverse
+from freezegun import freeze_time
+from wagtail.models import Page
+
+from wagtail_ab_testing.cache import get_cache
+from wagtail_ab_testing.ingest import StatsBatch, idempotency_keys, write_behind
+from wagtail_ab_testing.models import AbTest
+from wagtail_ab_testing.views import aregister_participant
+
+
+@freeze_time("2020-11-04T22:37:00Z")
+@override_settings(WAGTAIL_AB_TESTING_WRITE_BEHIND_INTERVAL=3600)
+class TestWriteBehind(TestCase):
+    def setUp(self):
+        self.page = Page.objects.get(id=2).add_child(
+            instance=Page(title="Test", slug="test")
+        )
+        self.ab_test = AbTest.objects.create(
+            page=self.page,
+            name="Test",
+            variant_revision=self.page.save_revision(),
+            status=AbTest.STATUS_RUNNING,
+            goal_page_id=2,
+            goal_event="visit-page",
+            sample_size=100,
+        )
+
+        # Don't start a background thread
+        patcher = patch.object(write_behind, "_start_thread")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(write_behind.flush)
+
+    def post(self, url_name, version):
+        response = self.client.post(
+            reverse(url_name), {"test_id": self.ab_test.id, "version": version}
+        )
+        self.assertEqual(response.status_code, 204)
+
+    def test_coalesces_until_flushed(self):
+        self.post("wagtail_ab_testing:register_participant", "control")
+        self.post("wagtail_ab_testing:register_participant", "control")
+        self.post("wagtail_ab_testing:goal_reached", "control")
+
+        self.assertFalse(self.ab_test.hourly_logs.exists())
+
+        write_behind.flush()
+
+        log = self.ab_test.hourly_logs.get()
+        self.assertEqual(log.date, datetime.date(2020, 11, 4))
+        self.assertEqual(log.hour, 22)
+        self.assertEqual(log.participants, 2)
+        self.assertEqual(log.conversions, 1)
+
+    async def test_async_doesnt_write_until_flushed(self):
+        for version in ["control", "variant"]:
+            request = AsyncRequestFactory().post(
+                reverse("wagtail_ab_testing:register_participant"),
+                {"test_id": self.ab_test.id, "version": version},
+                content_type="application/json",
+            )
+            response = await aregister_participant(request)
+            self.assertEqual(response.status_code, 204)
+
+        self.assertFalse(await self.ab_test.hourly_logs.aexists())
+
+        await sync_to_async(write_behind.flush)()
+
+        self.assertEqual(await self.ab_test.hourly_logs.acount(), 2)
+
+    @override_settings(WAGTAIL_AB_TESTING_WRITE_BEHIND_MAX_EVENTS=2)
+    def test_flushes_when_full(self):
+        self.post("wagtail_ab_testing:register_participant", "control")
+        self.assertFalse(self.ab_test.hourly_logs.exists())
+
+        self.post("wagtail_ab_testing:register_participant", "variant")
+        self.assertEqual(self.ab_test.hourly_logs.count(), 2)
+
+    def test_flush_finishes_test(self):
+        self.ab_test.sample_size = 2
+        self.ab_test.save()
+
+        self.post("wagtail_ab_testing:register_participant", "control")
+        self.post("wagtail_ab_testing:register_participant", "variant")
+        write_behind.flush()
+
+        self.ab_test.refresh_from_db()
+        self.assertEqual(self.ab_test.status, AbTest.STATUS_FINISHED)
+
+    def test_flush_logs_database_errors(self):
+        self.post("wagtail_ab_testing:goal_reached", "control")
+
+        with (
+            patch.object(StatsBatch, "apply", side_effect=DatabaseError),
+            self.assertLogs("wagtail_ab_testing.ingest", level="ERROR"),
+        ):
+            write_behind.flush()
+
+    def test_flush_logs_other_errors(self):
+        self.ab_test.sample_size = 1
+        self.ab_test.save()
+        self.post("wagtail_ab_testing:register_participant", "control")
+
+        with (
+            patch.object(AbTest, "finish", side_effect=ValueError),
+            self.assertLogs("wagtail_ab_testing.ingest", level="ERROR"),
+        ):
+            write_behind.flush()
+
+    def test_thread_survives_errors(self):
+        class StopLoop(BaseException):
+            pass
+
+        with (
+            patch.object(
+                write_behind, "flush", side_effect=[RuntimeError, StopLoop]
+            ) as flush,
+            patch("wagtail_ab_testing.ingest.time.sleep"),
+            patch("wagtail_ab_testing.ingest.close_old_connections"),
+            self.assertLogs("wagtail_ab_testing.ingest", level="ERROR"),
+            self.assertRaises(StopLoop),
+        ):
+            write_behind._run()
+
+        self.assertEqual(flush.call_count, 2)
+
+    @override_settings(WAGTAIL_AB_TESTING_WRITE_BEHIND_INTERVAL=None)
+    def test_disabled(self):
+        self.post("wagtail_ab_testing:goal_reached", "control")
+
+        self.assertEqual(self.ab_test.hourly_logs.get().conversions, 1)
+
+
+@freeze_time("2020-11-04T22:37:00Z")
+@override_settings(WAGTAIL_AB_TESTING_IDEMPOTENCY_KEY_TIMEOUT=3600)
+class TestIdempotencyKeys(TestCase):
+    def setUp(self):
+        get_cache().clear()
+
+        self.page = Page.objects.get(id=2).add_child(
+            instance=Page(title="Test", slug="test")
+        )
+        self.ab_test = AbTest.objects.create(
+            page=self.page,
+            name="Test",
+            variant_revision=self.page.save_revision(),
+            status=AbTest.STATUS_RUNNING,
+            goal_page_id=2,
+            goal_event="visit-page",
+            sample_size=100,
+        )
+
+    def post_events(self, events):
+        return self.client.post(
+            reverse("wagtail_ab_testing:events"),
+            {"events": events},
+            content_type="application/json",
+        )
+
+    def claim(self, items, kind=None):
+        with idempotency_keys.claim(items, kind) as new_items:
+            return new_items
+
+    def test_claim(self):
+        items = [
+            (1, "control", "conversion", None, "a"),
+            (1, "control", "conversion", None, None),
+            (1, "variant", "conversion", None, "a"),
+            (1, "control", "conversion", None, "b"),
+        ]
+
+        self.assertEqual(self.claim(items), [items[0], items[1], items[3]])
+        self.assertEqual(
+            self.claim(
+                [
+                    (1, "control", "conversion", None, "b"),
+                    (1, "control", "conversion", None, "c"),
+                ]
+            ),
+            [(1, "control", "conversion", None, "c")],
+        )
+
+    def test_keys_are_scoped_by_test_and_kind(self):
+        items = [
+            (1, "control", "participant", None, "a"),
+            (1, "control", "conversion", None, "a"),
+            (2, "control", "conversion", None, "a"),
+        ]
+
+        self.assertEqual(self.claim(items), items)
+        self.assertEqual(
+            self.claim([(1, "control", None, "a")], "delta"),
+            [(1, "control", None, "a")],
+        )
+
+    def test_keys_are_released_if_recording_fails(self):
+        items = [(1, "control", "conversion", None, "a")]
+
+        with self.assertRaises(DatabaseError):
+            with idempotency_keys.claim(items) as new_items:
+                self.assertEqual(new_items, items)
+                raise DatabaseError
+
+        # The event can be retried
+        self.assertEqual(self.claim(items), items)
+        self.assertEqual(self.claim(items), [])
+
+    @override_settings(WAGTAIL_AB_TESTING_IDEMPOTENCY_KEY_TIMEOUT=None)
+    def test_disabled(self):
+        items = [
+            (1, "control", "conversion", None, "a"),
+            (1, "control", "conversion", None, "a"),
+        ]
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.claim(items), items)
+
+    def test_retried_events_are_dropped(self):
+        event = {
+            "test_id": self.ab_test.id,
+            "version": "control",
+            "kind": "conversion",
+            "key": "abc",
+        }
+
+        self.assertEqual(self.post_events([event, event]).json(), {"accepted": 1})
+        self.assertEqual(self.post_events([event]).json(), {"accepted": 0})
+
+        self.assertEqual(self.ab_test.hourly_logs.get().conversions, 1)
+
+    def test_failed_events_can_be_retried(self):
+        event = {
+            "test_id": self.ab_test.id,
+            "version": "control",
+            "kind": "conversion",
+            "key": "abc",
+        }
+
+        with patch("wagtail_ab_testing.views.record_batch", side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                self.post_events([event])
+
+        self.assertEqual(self.post_events([event]).json(), {"accepted": 1})
+
+    def test_invalid_key(self):
+        response = self.post_events(
+            [
+                {
+                    "test_id": self.ab_test.id,
+                    "version": "control",
+                    "kind": "conversion",
+                    "key": "x" * 101,
+                }
+            ]
+        )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            response.json(), "key must be a string of up to 100 characters"
+        )
+
+    def test_idempotency_key_header(self):
+        for i in range(2):
+            response = self.client.post(
+                reverse("wagtail_ab_testing:goal_reached"),
+                {"test_id": self.ab_test.id, "version": "variant"},
+                headers={"Idempotency-Key": "abc"},
+            )
+            self.assertEqual(response.status_code, 204)
+
+        self.assertEqual(self.ab_test.hourly_logs.get().conversions, 1)
+
+    @override_settings(WAGTAIL_AB_TESTING_WORKER_TOKEN="secret")
+    def test_retried_deltas_are_dropped(self):
+        for i in range(2):
+            self.client.post(
+                reverse("wagtail_ab_testing:deltas"),
+                {
+                    "deltas": [
+                        {
+                            "test_id": self.ab_test.id,
+                            "version": "control",
+                            "participants": 10,
+                            "key": "worker-1:2020-11-04T22",
+                        }
+                    ]
+                },
+                content_type="application/json",
+                headers={"Authorization": "Token secret"},
+            )
+
+        self.assertEqual(self.ab_test.hourly_logs.get().participants, 10)
+
+    async def test_async(self):
+        items = [
+            (1, "control", "conversion", None, "a"),
+            (1, "control", "conversion", None, "a"),
+        ]
+
+        async with idempotency_keys.aclaim(items) as new_items:
+            self.assertEqual(new_items, items[:1])
+
+        async with idempotency_keys.aclaim(items) as new_items:
+            self.assertEqual(new_items, [])
+
+    async def test_async_keys_are_released_if_recording_fails(self):
+        items = [(1, "control", "conversion", None, "a")]
+
+        with self.assertRaises(DatabaseError):
+            async with idempotency_keys.aclaim(items):
+                raise DatabaseError
+
+        async with idempotency_keys.aclaim(items) as new_items:
+            self.assertEqual(new_items, items)
@@ -0,0 +1,190 @@
+from django.test import AsyncRequestFactory, TestCase, override_settings
+from django.urls import reverse
+from freezegun import freeze_time
+from wagtail.models import Page
+
+from wagtail_ab_testing.cache import get_cache
+from wagtail_ab_testing.models import AbTest
+from wagtail_ab_testing.ratelimit import ip_rate_limiter, test_rate_limiter
+from wagtail_ab_testing.views import aregister_participant
+
+
+@override_settings(WAGTAIL_AB_TESTING_RATE_LIMIT_PER_IP=(2, 60))
+class TestRateLimiter(TestCase):
+    def setUp(self):
+        get_cache().clear()
+
+    def test_limits_events_in_sliding_window(self):
+        with freeze_time("2020-11-04T22:37:00Z") as frozen_time:
+            self.assertTrue(ip_rate_limiter.allow("1.2.3.4"))
+            self.assertTrue(ip_rate_limiter.allow("1.2.3.4"))
+            self.assertFalse(ip_rate_limiter.allow("1.2.3.4"))
+
+            # Other identifiers have their own limit
+            self.assertTrue(ip_rate_limiter.allow("5.6.7.8"))
+
+            # All of the previous window still counts at the start of the next one
+            frozen_time.tick(60)
+            self.assertFalse(ip_rate_limiter.allow("1.2.3.4"))
+
+            # Half of it counts halfway through
+            frozen_time.tick(30)
+            self.assertTrue(ip_rate_limiter.allow("1.2.3.4"))
+            self.assertFalse(ip_rate_limiter.allow("1.2.3.4"))
+
+            self.assertEqual(ip_rate_limiter.get_dropped_count(), 3)
+
+    def test_counts_several_events(self):
+        with freeze_time("2020-11-04T22:37:00Z"):
+            self.assertFalse(ip_rate_limiter.allow("1.2.3.4", 3))
+
+            # Dropped events don't count towards the limit
+            self.assertTrue(ip_rate_limiter.allow("1.2.3.4", 2))
+            self.assertFalse(ip_rate_limiter.allow("1.2.3.4"))
+
+            self.assertEqual(ip_rate_limiter.get_dropped_count(), 4)
+
+    async def test_async(self):
+        with freeze_time("2020-11-04T22:37:00Z"):
+            self.assertTrue(await ip_rate_limiter.aallow("1.2.3.4", 2))
+            self.assertFalse(await ip_rate_limiter.aallow("1.2.3.4"))
+            self.assertTrue(await ip_rate_limiter.aallow("5.6.7.8"))
+
+    @override_settings(WAGTAIL_AB_TESTING_RATE_LIMIT_PER_IP=None)
+    def test_disabled(self):
+        with self.assertNumQueries(0):
+            for i in range(10):
+                self.assertTrue(ip_rate_limiter.allow("1.2.3.4"))
+
+
+@freeze_time("2020-11-04T22:37:00Z")
+class TestRateLimitedEndpoints(TestCase):
+    def setUp(self):
+        get_cache().clear()
+
+        page = Page.objects.get(id=2).add_child(
+            instance=Page(title="Test", slug="test")
+        )
+        self.ab_test = AbTest.objects.create(
+            page=page,
+            name="Test",
+            variant_revision=page.save_revision(),
+            status=AbTest.STATUS_RUNNING,
+            goal_page_id=2,
+            goal_event="visit-page",
+            sample_size=100,
+        )
+
+    def register_participant(self, **extra):
+        return self.client.post(
+            reverse("wagtail_ab_testing:register_participant"),
+            {"test_id": self.ab_test.id, "version": "control"},
+            **extra,
+        )
+
+    @override_settings(WAGTAIL_AB_TESTING_RATE_LIMIT_PER_IP=(1, 60))
+    def test_limit_per_ip(self):
+        self.assertEqual(self.register_participant().status_code, 204)
+
+        response = self.register_participant()
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.json(), "rate limit exceeded")
+
+        # Other clients aren't affected
+        self.assertEqual(
+            self.register_participant(REMOTE_ADDR="10.0.0.1").status_code, 204
+        )
+
+        self.assertEqual(self.ab_test.hourly_logs.get().participants, 2)
+        self.assertEqual(ip_rate_limiter.get_dropped_count(), 1)
+
+    def goal_reached(self, **extra):
+        return self.client.post(
+            reverse("wagtail_ab_testing:goal_reached"),
+            {"test_id": self.ab_test.id, "version": "control"},
+            **extra,
+        )
+
+    @override_settings(WAGTAIL_AB_TESTING_RATE_LIMIT_PER_TEST=(1, 60))
+    def test_limit_per_test(self):
+        self.assertEqual(self.goal_reached().status_code, 204)
+        self.assertEqual(self.goal_reached(REMOTE_ADDR="10.0.0.1").status_code, 429)
+
+        self.assertEqual(self.ab_test.hourly_logs.get().conversions, 1)
+        self.assertEqual(test_rate_limiter.get_dropped_count(), 1)
+
+    @override_settings(WAGTAIL_AB_TESTING_RATE_LIMIT_PER_TEST=(1, 60))
+    def test_participants_dont_count_towards_test_limit(self):
+        # Visitors already have their assignment, so dropping the participant
+        # would leave their conversions without one
+        self.assertEqual(self.register_participant().status_code, 204)
+        self.assertEqual(
+            self.register_participant(REMOTE_ADDR="10.0.0.1").status_code, 204
+        )
+        self.assertEqual(self.goal_reached().status_code, 204)
+
+        log = self.ab_test.hourly_logs.get()
+        self.assertEqual(log.participants, 2)
+        self.assertEqual(log.conversions, 1)
+        self.assertEqual(test_rate_limiter.get_dropped_count(), 0)
+
+    @override_settings(WAGTAIL_AB_TESTING_RATE_LIMIT_PER_TEST=(2, 60))
+    def test_events_over_test_limit_are_dropped(self):
+        participant = {
+            "test_id": self.ab_test.id,
+            "version": "control",
+            "kind": "participant",
+        }
+        conversion = {
+            "test_id": self.ab_test.id,
+            "version": "control",
+            "kind": "conversion",
+        }
+
+        response = self.client.post(
+            reverse("wagtail_ab_testing:events"),
+            {"events": [participant, participant, conversion, conversion]},
+            content_type="application/json",
+        )
+        self.assertEqual(response.json(), {"accepted": 4})
+
+        # Only the conversion is over the limit
+        response = self.client.post(
+            reverse("wagtail_ab_testing:events"),
+            {"events": [participant, conversion]},
+            content_type="application/json",
+        )
+        self.assertEqual(response.json(), {"accepted": 1})
+
+        log = self.ab_test.hourly_logs.get()
+        self.assertEqual(log.participants, 3)
+        self.assertEqual(log.conversions, 2)
+        self.assertEqual(test_rate_limiter.get_dropped_count(), 1)
+
+    @override_settings(WAGTAIL_AB_TESTING_RATE_LIMIT_PER_IP=(2, 60))
+    def test_events_count_towards_ip_limit(self):
+        event = {
+            "test_id": self.ab_test.id,
+            "version": "control",
+            "kind": "participant",
+        }
+
+        response = self.client.post(
+            reverse("wagtail_ab_testing:events"),
+            {"events": [event, event, event]},
+            content_type="application/json",
+        )
+
+        self.assertEqual(response.status_code, 429)
+        self.assertFalse(self.ab_test.hourly_logs.exists())
+
+    @override_settings(WAGTAIL_AB_TESTING_RATE_LIMIT_PER_IP=(1, 60))
+    async def test_limit_per_ip_async(self):
+        for expected_status in [204, 429]:
+            request = AsyncRequestFactory().post(
+                reverse("wagtail_ab_testing:register_participant"),
+                {"test_id": self.ab_test.id, "version": "variant"},
+                content_type="application/json",
+            )
+            response = await aregister_participant(request)
+            self.assertEqual(response.status_code, expected_status)
@@ -1,7 +1,34 @@
-from django.test import TestCase, override_settings
-from wagtail.models import Page
-
-from wagtail_ab_testing.models import AbTest
+import email
+import gzip
+from concurrent.futures import ThreadPoolExecutor
+from unittest import skipIf
+from unittest.mock import patch
+
+from django.contrib.auth import get_user_model
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.models import F
+from django.test import (
+    RequestFactory,
+    TestCase,
+    modify_settings,
+    override_settings,
+)
+from django.urls import get_script_prefix, get_urlconf
+from django.utils import timezone
+from django.utils.functional import empty
+from freezegun import freeze_time
+from wagtail.models import Page, Revision
+
+from wagtail_ab_testing.cache import (
+    STATE_ID,
+    bump_generation,
+    participant_counts,
+    running_tests,
+    variant_pages,
+)
+from wagtail_ab_testing.compat import brotli
+from wagtail_ab_testing.models import AbTest, AbTestingState
+from wagtail_ab_testing.wagtail_hooks import compress_brotli, serve_version_in_thread
 
 
 class TestServe(TestCase):
@@ -43,6 +70,73 @@ class TestServe(TestCase):
         self.assertNotContains(response, "Welcome to your new Wagtail site!")
         self.assertContains(response, "Changed title")
 
+    def test_serves_variant_from_assignments_cookie(self):
+        self.client.cookies["wagtail-ab-testing"] = f"999:c|{self.ab_test.id}:v"
+
+        response = self.client.get("/")
+        self.assertEqual(response.status_code, 200)
+
+        self.assertNotContains(response, "Welcome to your new Wagtail site!")
+        self.assertContains(response, "Changed title")
+
+    def test_assignments_cookie_takes_precedence_over_legacy_cookie(self):
+        self.client.cookies["wagtail-ab-testing"] = f"{self.ab_test.id}:c"
+        self.client.cookies[f"wagtail-ab-testing_{self.ab_test.id}_version"] = (
+            AbTest.VERSION_VARIANT
+        )
+
+        response = self.client.get("/")
+        self.assertEqual(response.status_code, 200)
+
+        self.assertContains(response, "Welcome to your new Wagtail site!")
+        self.assertNotContains(response, "Changed title")
+
+    def test_ignores_malformed_assignments(self):
+        # Add a participant for control so new participants get the variant
+        self.ab_test.add_participant(AbTest.VERSION_CONTROL)
+        self.client.cookies["wagtail-ab-testing"] = f"{self.ab_test.id}:x|abc:c|:"
+
+        response = self.client.get("/")
+        self.assertEqual(response.status_code, 200)
+
+        self.assertContains(response, "Changed title")
+
+    @override_settings(WAGTAIL_AB_TESTING_VISITOR_ID_COOKIE="visitor_id")
+    def test_serves_version_from_visitor_id(self):
+        self.client.cookies["visitor_id"] = "abc"
+        expected_version = self.ab_test.get_version_for_visitor("abc")
+
+        with patch.object(AbTest, "get_new_participant_version") as mock:
+            response = self.client.get("/")
+
+        self.assertEqual(response.status_code, 200)
+        mock.assert_not_called()
+
+        if expected_version == AbTest.VERSION_VARIANT:
+            self.assertContains(response, "Changed title")
+        else:
+            self.assertNotContains(response, "Changed title")
+
+    @override_settings(WAGTAIL_AB_TESTING_VISITOR_ID_COOKIE="visitor_id")
+    def test_assignment_takes_precedence_over_visitor_id(self):
+        self.client.cookies["visitor_id"] = "abc"
+        version = self.ab_test.get_version_for_visitor("abc")
+        other_version = (
+            AbTest.VERSION_CONTROL
+            if version == AbTest.VERSION_VARIANT
+            else AbTest.VERSION_VARIANT
+        )
+        self.client.cookies["wagtail-ab-testing"] = (
+            f"{self.ab_test.id}:{other_version[0]}"
+        )
+
+        response = self.client.get("/")
+
+        if other_version == AbTest.VERSION_VARIANT:
+            self.assertContains(response, "Changed title")
+        else:
+            self.assertNotContains(response, "Changed title")
+
     def test_serves_control_to_new_participant(self):
         # Add a participant for variant
         # This will make the new participant use control to balance the numbers
@@ -83,6 +177,21 @@ class TestServe(TestCase):
             f"wagtail-ab-testing_{self.ab_test.id}_version", self.client.session
         )
 
+    def test_serves_control_after_pause(self):
+        self.client.cookies[f"wagtail-ab-testing_{self.ab_test.id}_version"] = (
+            AbTest.VERSION_VARIANT
+        )
+
+        response = self.client.get("/")
+        self.assertContains(response, "Changed title")
+
+        # Pausing the test must invalidate the registry of running tests
+        self.ab_test.pause()
+
+        response = self.client.get("/")
+        self.assertContains(response, "Welcome to your new Wagtail site!")
+        self.assertNotContains(response, "Changed title")
+
     def test_doesnt_track_bots(self):
         # Add a participant for control
         # This will make it serve the variant if it does incorrectly decide to track the user
@@ -131,6 +240,248 @@ class TestServe(TestCase):
         self.assertIn("Welcome to your new Wagtail site!", response_data["control"])
         self.assertIn("Changed title", response_data["variant"])
 
+    @override_settings(
+        WAGTAIL_AB_TESTING_WORKER_TOKEN="abc123",
+        WAGTAIL_AB_TESTING_WORKER_CONCURRENT_RENDERING=True,
+    )
+    def test_serves_dual_response_for_worker_concurrently(self):
+        # Share this test's database connection with the render thread so it can see the test data
+        connection = connections[DEFAULT_DB_ALIAS]
+        connection.inc_thread_sharing()
+        executor = ThreadPoolExecutor(
+            max_workers=1,
+            initializer=connections.__setitem__,
+            initargs=[DEFAULT_DB_ALIAS, connection],
+        )
+
+        try:
+            with (
+                patch(
+                    "wagtail_ab_testing.wagtail_hooks.get_render_executor",
+                    return_value=executor,
+                ),
+                patch("wagtail_ab_testing.wagtail_hooks.close_old_connections"),
+                patch(
+                    "wagtail_ab_testing.wagtail_hooks.serve_version_in_thread",
+                    side_effect=serve_version_in_thread,
+                ) as serve_in_thread,
+            ):
+                response = self.client.get(
+                    "/",
+                    HTTP_X_REQUESTED_WITH="WagtailAbTestingWorker",
+                    HTTP_AUTHORIZATION="Token abc123",
+                )
+        finally:
+            executor.shutdown()
+            connection.dec_thread_sharing()
+
+        self.assertEqual(response.status_code, 200)
+        serve_in_thread.assert_called_once()
+
+        # The variant must be rendered with a copy of the request
+        variant_request = serve_in_thread.call_args.args[7]
+        self.assertIsNot(variant_request, response.wsgi_request)
+
+        # The user that the copy shares with the request was loaded before it was copied
+        self.assertIsNot(variant_request.user._wrapped, empty)
+        self.assertTrue(variant_request.wagtail_ab_testing_serving_variant)
+        self.assertFalse(
+            hasattr(response.wsgi_request, "wagtail_ab_testing_serving_variant")
+        )
+
+        self.assertEqual(response["X-WagtailAbTesting-Test"], str(self.ab_test.id))
+        response_data = response.json()
+
+        self.assertIn("Welcome to your new Wagtail site!", response_data["control"])
+        self.assertIn("Changed title", response_data["variant"])
+
+    def test_serve_version_in_thread(self):
+        def serve_cached_version(*args):
+            return get_script_prefix(), get_urlconf()
+
+        with (
+            patch(
+                "wagtail_ab_testing.wagtail_hooks.serve_cached_version",
+                side_effect=serve_cached_version,
+            ),
+            patch("wagtail_ab_testing.wagtail_hooks.close_old_connections"),
+            ThreadPoolExecutor(max_workers=1) as executor,
+        ):
+            result = executor.submit(
+                serve_version_in_thread,
+                "en",
+                timezone.get_current_timezone(),
+                "/prefix/",
+                "wagtail_ab_testing.test.urls",
+            ).result()
+
+            # The thread is reset for the next request
+            thread_state = executor.submit(
+                lambda: (get_script_prefix(), get_urlconf())
+            ).result()
+
+        self.assertEqual(result, ("/prefix/", "wagtail_ab_testing.test.urls"))
+        self.assertEqual(thread_state, ("/", None))
+
+    def get_multipart_worker_response(self, **kwargs):
+        response = self.client.get(
+            "/",
+            HTTP_X_REQUESTED_WITH="WagtailAbTestingWorker",
+            HTTP_AUTHORIZATION="Token abc123",
+            HTTP_ACCEPT="multipart/form-data",
+            **kwargs,
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["X-WagtailAbTesting-Test"], str(self.ab_test.id))
+        self.assertTrue(response.streaming)
+
+        return response
+
+    def parse_multipart_response(self, response, content):
+        message = email.message_from_bytes(
+            b"Content-Type: "
+            + response["Content-Type"].encode()
+            + b"\r\n\r\n"
+            + content
+        )
+
+        return {
+            part.get_param("name", header="Content-Disposition"): part.get_payload(
+                decode=True
+            ).decode()
+            for part in message.get_payload()
+        }
+
+    @override_settings(WAGTAIL_AB_TESTING_WORKER_TOKEN="abc123")
+    def test_streams_dual_response_for_worker(self):
+        response = self.get_multipart_worker_response()
+        self.assertFalse(response.has_header("Content-Encoding"))
+
+        parts = self.parse_multipart_response(
+            response, b"".join(response.streaming_content)
+        )
+        self.assertIn("Welcome to your new Wagtail site!", parts["control"])
+        self.assertIn("Changed title", parts["variant"])
+
+    @override_settings(WAGTAIL_AB_TESTING_WORKER_TOKEN="abc123")
+    def test_streams_gzipped_dual_response_for_worker(self):
+        response = self.get_multipart_worker_response(HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+
+        parts = self.parse_multipart_response(
+            response, gzip.decompress(b"".join(response.streaming_content))
+        )
+        self.assertIn("Welcome to your new Wagtail site!", parts["control"])
+        self.assertIn("Changed title", parts["variant"])
+
+    @skipIf(brotli is None, "brotli is not installed")
+    @override_settings(WAGTAIL_AB_TESTING_WORKER_TOKEN="abc123")
+    def test_streams_brotli_compressed_dual_response_for_worker(self):
+        response = self.get_multipart_worker_response(HTTP_ACCEPT_ENCODING="gzip, br")
+        self.assertEqual(response["Content-Encoding"], "br")
+
+        parts = self.parse_multipart_response(
+            response, brotli.decompress(b"".join(response.streaming_content))
+        )
+        self.assertIn("Welcome to your new Wagtail site!", parts["control"])
+        self.assertIn("Changed title", parts["variant"])
+
+    @skipIf(brotli is None, "brotli is not installed")
+    def test_compress_brotli(self):
+        chunks = list(compress_brotli([b"Hello ", b"", b"world"]))
+
+        self.assertNotIn(b"", chunks)
+        self.assertEqual(brotli.decompress(b"".join(chunks)), b"Hello world")
+
+    @override_settings(WAGTAIL_AB_TESTING_WORKER_TOKEN="abc123")
+    def test_streamed_dual_response_has_content(self):
+        # Code that expects an HttpResponse from the hook can still read the content
+        response = self.get_multipart_worker_response(HTTP_ACCEPT_ENCODING="gzip")
+
+        parts = self.parse_multipart_response(
+            response, gzip.decompress(response.content)
+        )
+        self.assertIn("Changed title", parts["variant"])
+
+    @override_settings(WAGTAIL_AB_TESTING_WORKER_TOKEN="abc123")
+    def test_streamed_dual_response_rendering_errors_are_raised(self):
+        with patch(
+            "wagtail_ab_testing.wagtail_hooks.variant_pages.get_variant_page",
+            side_effect=ValueError,
+        ):
+            with self.assertRaises(ValueError):
+                self.client.get(
+                    "/",
+                    HTTP_X_REQUESTED_WITH="WagtailAbTestingWorker",
+                    HTTP_AUTHORIZATION="Token abc123",
+                    HTTP_ACCEPT="multipart/form-data",
+                )
+
+    @override_settings(WAGTAIL_AB_TESTING_WORKER_TOKEN="abc123")
+    async def test_streams_dual_response_for_worker_asynchronously(self):
+        response = await self.async_client.get(
+            "/",
+            headers={
+                "X-Requested-With": "WagtailAbTestingWorker",
+                "Authorization": "Token abc123",
+                "Accept": "multipart/form-data",
+            },
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_async)
+
+        parts = self.parse_multipart_response(
+            response, b"".join([chunk async for chunk in response.streaming_content])
+        )
+        self.assertIn("Welcome to your new Wagtail site!", parts["control"])
+        self.assertIn("Changed title", parts["variant"])
+
+    @override_settings(WAGTAIL_AB_TESTING_WORKER_TOKEN="abc123")
+    def test_serves_requested_version_for_worker(self):
+        for version, content in [
+            (AbTest.VERSION_CONTROL, "Welcome to your new Wagtail site!"),
+            (AbTest.VERSION_VARIANT, "Changed title"),
+        ]:
+            with self.subTest(version=version):
+                response = self.client.get(
+                    "/",
+                    HTTP_X_REQUESTED_WITH="WagtailAbTestingWorker",
+                    HTTP_AUTHORIZATION="Token abc123",
+                    HTTP_X_WAGTAILABTESTING_VERSION=version,
+                )
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(
+                    response["X-WagtailAbTesting-Test"], str(self.ab_test.id)
+                )
+                self.assertEqual(response["X-WagtailAbTesting-Version"], version)
+                self.assertIn("X-WagtailAbTesting-Version", response["Vary"])
+                self.assertContains(response, content)
+
+    @override_settings(WAGTAIL_AB_TESTING_WORKER_TOKEN="abc123")
+    def test_worker_requested_version_doesnt_override_cookie(self):
+        self.client.cookies[f"wagtail-ab-testing_{self.ab_test.id}_version"] = (
+            AbTest.VERSION_CONTROL
+        )
+
+        response = self.client.get(
+            "/",
+            HTTP_X_REQUESTED_WITH="WagtailAbTestingWorker",
+            HTTP_AUTHORIZATION="Token abc123",
+            HTTP_X_WAGTAILABTESTING_VERSION=AbTest.VERSION_VARIANT,
+        )
+        self.assertEqual(response["X-WagtailAbTesting-Version"], "control")
+        self.assertContains(response, "Welcome to your new Wagtail site!")
+
+    @override_settings(WAGTAIL_AB_TESTING_WORKER_TOKEN="abc123")
+    def test_worker_requested_version_must_be_valid(self):
+        response = self.client.get(
+            "/",
+            HTTP_X_REQUESTED_WITH="WagtailAbTestingWorker",
+            HTTP_AUTHORIZATION="Token abc123",
+            HTTP_X_WAGTAILABTESTING_VERSION="foo",
+        )
+        self.assertEqual(response.status_code, 400)
+
     @override_settings(WAGTAIL_AB_TESTING_WORKER_TOKEN="abc123")
     def test_worker_requires_token(self):
         response = self.client.get("/", HTTP_X_REQUESTED_WITH="WagtailAbTestingWorker")
@@ -145,3 +496,394 @@ class TestServe(TestCase):
             HTTP_AUTHORIZATION="Token wrongtoken",
         )
         self.assertEqual(response.status_code, 403)
+
+
+class TestRunningTestRegistry(TestCase):
+    def setUp(self):
+        self.home_page = Page.objects.get(id=2)
+        self.other_page = self.home_page.add_child(
+            instance=Page(title="Other", slug="other")
+        )
+        self.home_page.title = "Changed title"
+        self.ab_test = AbTest.objects.create(
+            page=self.home_page,
+            name="Test",
+            variant_revision=self.home_page.save_revision(),
+            goal_event="visit-page",
+            sample_size=10,
+            status=AbTest.STATUS_RUNNING,
+        )
+
+    def test_get_for_page(self):
+        self.assertEqual(running_tests.get_for_page(self.home_page.id), self.ab_test)
+        self.assertIsNone(running_tests.get_for_page(self.other_page.id))
+
+    @override_settings(WAGTAIL_AB_TESTING_STATE_CHECK_INTERVAL=60)
+    def test_lookup_doesnt_query_once_loaded(self):
+        running_tests.get_for_page(self.other_page.id)
+
+        with self.assertNumQueries(0):
+            self.assertIsNone(running_tests.get_for_page(self.other_page.id))
+            self.assertEqual(
+                running_tests.get_for_page(self.home_page.id), self.ab_test
+            )
+
+    def test_invalidated_on_status_change(self):
+        self.assertIsNotNone(running_tests.get_for_page(self.home_page.id))
+
+        self.ab_test.pause()
+        self.assertIsNone(running_tests.get_for_page(self.home_page.id))
+
+        self.ab_test.start()
+        self.assertIsNotNone(running_tests.get_for_page(self.home_page.id))
+
+        self.ab_test.cancel()
+        self.assertIsNone(running_tests.get_for_page(self.home_page.id))
+
+    @override_settings(WAGTAIL_AB_TESTING_STATE_CHECK_INTERVAL=0)
+    def test_invalidated_by_other_process(self):
+        self.assertIsNotNone(running_tests.get_for_page(self.home_page.id))
+
+        # Simulate another process pausing the test
+        AbTest.objects.filter(id=self.ab_test.id).update(status=AbTest.STATUS_PAUSED)
+        self.assertIsNotNone(running_tests.get_for_page(self.home_page.id))
+
+        AbTestingState.objects.filter(id=STATE_ID).update(
+            generation=F("generation") + 1
+        )
+        self.assertIsNone(running_tests.get_for_page(self.home_page.id))
+
+    def test_generation_row_is_created_when_missing(self):
+        AbTestingState.objects.all().delete()
+
+        bump_generation()
+        self.assertEqual(AbTestingState.objects.get().id, STATE_ID)
+
+        bump_generation()
+        self.assertEqual(AbTestingState.objects.get().generation, 1)
+
+    def test_shared_generation_checked_once_per_request(self):
+        request = RequestFactory().get("/")
+        running_tests.get_for_page(self.home_page.id, request)
+
+        with self.assertNumQueries(0):
+            running_tests.get_for_page(self.other_page.id, request)
+
+    @freeze_time("2026-01-01")
+    def test_shared_generation_checked_once_per_interval_by_default(self):
+        running_tests.get_for_page(self.home_page.id, RequestFactory().get("/"))
+
+        with self.assertNumQueries(0):
+            self.assertIsNone(
+                running_tests.get_for_page(
+                    self.other_page.id, RequestFactory().get("/other/")
+                )
+            )
+
+    def test_get_for_goal(self):
+        self.ab_test.goal_page = self.other_page
+        self.ab_test.save()
+
+        self.assertEqual(
+            running_tests.get_for_goal(self.other_page.id, "visit-page"),
+            [self.ab_test],
+        )
+        self.assertEqual(
+            running_tests.get_for_goal(self.home_page.id, "visit-page"), []
+        )
+        self.assertEqual(
+            running_tests.get_for_goal(self.other_page.id, "custom-event"), []
+        )
+
+    def test_returns_copy(self):
+        ab_test = running_tests.get_for_page(self.home_page.id)
+        ab_test.status = AbTest.STATUS_FINISHED
+
+        self.assertEqual(
+            running_tests.get_for_page(self.home_page.id).status,
+            AbTest.STATUS_RUNNING,
+        )
+
+
+@modify_settings(
+    MIDDLEWARE={"append": "wagtail_ab_testing.middleware.ConversionMiddleware"}
+)
+class TestConversionMiddleware(TestCase):
+    def setUp(self):
+        self.home_page = Page.objects.get(id=2)
+        self.goal_page = self.home_page.add_child(
+            instance=Page(title="Goal", slug="goal")
+        )
+        self.ab_test = AbTest.objects.create(
+            page=self.home_page,
+            name="Test",
+            variant_revision=self.home_page.save_revision(),
+            goal_event="visit-page",
+            goal_page=self.goal_page,
+            sample_size=10,
+            status=AbTest.STATUS_RUNNING,
+        )
+
+    def test_records_conversion(self):
+        self.client.cookies["wagtail-ab-testing"] = f"{self.ab_test.id}:v"
+
+        response = self.client.get("/goal/")
+        self.assertEqual(response.status_code, 200)
+
+        log = self.ab_test.hourly_logs.get()
+        self.assertEqual(log.version, AbTest.VERSION_VARIANT)
+        self.assertEqual(log.conversions, 1)
+        self.assertEqual(
+            response.cookies["wagtail-ab-testing-conversions"].value,
+            str(self.ab_test.id),
+        )
+
+        # The cookie stops the conversion from being counted again
+        response = self.client.get("/goal/")
+        self.assertNotIn("wagtail-ab-testing-conversions", response.cookies)
+        self.assertEqual(self.ab_test.hourly_logs.get().conversions, 1)
+
+    def test_ignores_visitors_that_arent_participants(self):
+        response = self.client.get("/goal/")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(self.ab_test.hourly_logs.exists())
+        self.assertNotIn("wagtail-ab-testing-conversions", response.cookies)
+
+    def test_ignores_other_pages(self):
+        self.client.cookies["wagtail-ab-testing"] = f"{self.ab_test.id}:v"
+
+        response = self.client.get("/")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(self.ab_test.hourly_logs.exists())
+
+    def test_ignores_tests_that_arent_running(self):
+        self.ab_test.pause()
+        self.client.cookies["wagtail-ab-testing"] = f"{self.ab_test.id}:v"
+
+        self.client.get("/goal/")
+
+        self.assertFalse(self.ab_test.hourly_logs.exists())
+
+    def test_ignores_untrackable_requests(self):
+        self.client.cookies["wagtail-ab-testing"] = f"{self.ab_test.id}:v"
+
+        self.client.get("/goal/", HTTP_DNT="1")
+
+        self.assertFalse(self.ab_test.hourly_logs.exists())
+
+    def test_ignores_head_requests(self):
+        self.client.cookies["wagtail-ab-testing"] = f"{self.ab_test.id}:v"
+
+        response = self.client.head("/goal/")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(self.ab_test.hourly_logs.exists())
+
+    def test_ignores_worker_requests(self):
+        self.client.cookies["wagtail-ab-testing"] = f"{self.ab_test.id}:v"
+
+        response = self.client.get(
+            "/goal/", HTTP_X_REQUESTED_WITH="WagtailAbTestingWorker"
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(self.ab_test.hourly_logs.exists())
+
+
+class TestVariantPageCache(TestCase):
+    def setUp(self):
+        self.home_page = Page.objects.get(id=2)
+        self.home_page.title = "Changed title"
+        self.ab_test = AbTest.objects.create(
+            page=self.home_page,
+            name="Test",
+            variant_revision=self.home_page.save_revision(),
+            goal_event="visit-page",
+            sample_size=10,
+            status=AbTest.STATUS_RUNNING,
+        )
+
+    def test_revision_deserialized_once(self):
+        with patch.object(
+            Revision, "as_object", autospec=True, side_effect=Revision.as_object
+        ) as as_object:
+            first = variant_pages.get_variant_page(self.ab_test)
+            second = variant_pages.get_variant_page(self.ab_test)
+
+        self.assertEqual(as_object.call_count, 1)
+        self.assertEqual(first.title, "Changed title")
+        self.assertEqual(second.title, "Changed title")
+
+    def test_returns_copy(self):
+        page = variant_pages.get_variant_page(self.ab_test)
+        page.title = "Mutated"
+
+        self.assertEqual(
+            variant_pages.get_variant_page(self.ab_test).title, "Changed title"
+        )
+
+    def test_evicted_when_test_stops_running(self):
+        variant_pages.get_variant_page(self.ab_test)
+        self.ab_test.pause()
+        self.ab_test.start()
+
+        with patch.object(
+            Revision, "as_object", autospec=True, side_effect=Revision.as_object
+        ) as as_object:
+            variant_pages.get_variant_page(self.ab_test)
+
+        self.assertEqual(as_object.call_count, 1)
+
+    @override_settings(WAGTAIL_AB_TESTING_VARIANT_CACHE_SIZE=0)
+    def test_disabled(self):
+        with patch.object(
+            Revision, "as_object", autospec=True, side_effect=Revision.as_object
+        ) as as_object:
+            variant_pages.get_variant_page(self.ab_test)
+            variant_pages.get_variant_page(self.ab_test)
+
+        self.assertEqual(as_object.call_count, 2)
+
+
+@override_settings(WAGTAIL_AB_TESTING_RESPONSE_CACHE_TIMEOUT=60)
+class TestRenderedResponseCache(TestCase):
+    def setUp(self):
+        self.home_page = Page.objects.get(id=2)
+        self.home_page.title = "Changed title"
+        self.ab_test = AbTest.objects.create(
+            page=self.home_page,
+            name="Test",
+            variant_revision=self.home_page.save_revision(),
+            goal_event="visit-page",
+            sample_size=10,
+            status=AbTest.STATUS_RUNNING,
+        )
+
+    def get(self, version, **kwargs):
+        self.client.cookies[f"wagtail-ab-testing_{self.ab_test.id}_version"] = version
+        return self.client.get("/", **kwargs)
+
+    def test_serves_cached_versions(self):
+        with patch.object(
+            Page, "serve", autospec=True, side_effect=Page.serve
+        ) as serve:
+            for i in range(2):
+                response = self.get(AbTest.VERSION_CONTROL)
+                self.assertContains(response, "Welcome to your new Wagtail site!")
+
+                response = self.get(AbTest.VERSION_VARIANT)
+                self.assertContains(response, "Changed title")
+
+        # Each version is rendered once
+        self.assertEqual(serve.call_count, 2)
+
+    def test_doesnt_cache_for_logged_in_users(self):
+        self.client.force_login(
+            get_user_model().objects.create_user(username="test", password="test")
+        )
+
+        with patch.object(
+            Page, "serve", autospec=True, side_effect=Page.serve
+        ) as serve:
+            self.get(AbTest.VERSION_VARIANT)
+            self.get(AbTest.VERSION_VARIANT)
+
+        self.assertEqual(serve.call_count, 2)
+
+    def test_invalidated_on_status_change(self):
+        self.get(AbTest.VERSION_VARIANT)
+        self.ab_test.pause()
+        self.ab_test.start()
+
+        with patch.object(
+            Page, "serve", autospec=True, side_effect=Page.serve
+        ) as serve:
+            self.get(AbTest.VERSION_VARIANT)
+
+        self.assertEqual(serve.call_count, 1)
+
+    def test_invalidated_on_publish(self):
+        self.get(AbTest.VERSION_CONTROL)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.home_page.title = "Published title"
+            self.home_page.save_revision().publish()
+
+            # The cache isn't invalidated until the new revision is committed
+            response = self.get(AbTest.VERSION_CONTROL)
+            self.assertNotContains(response, "Published title")
+
+        response = self.get(AbTest.VERSION_CONTROL)
+        self.assertContains(response, "Published title")
+
+    @override_settings(WAGTAIL_AB_TESTING_WORKER_TOKEN="abc123")
+    def test_serves_cached_versions_to_workers(self):
+        with patch.object(
+            Page, "serve", autospec=True, side_effect=Page.serve
+        ) as serve:
+            for i in range(2):
+                response = self.client.get(
+                    "/",
+                    HTTP_X_REQUESTED_WITH="WagtailAbTestingWorker",
+                    HTTP_AUTHORIZATION="Token abc123",
+                )
+                response_data = response.json()
+                self.assertIn(
+                    "Welcome to your new Wagtail site!", response_data["control"]
+                )
+                self.assertIn("Changed title", response_data["variant"])
+
+        # Each version is rendered once
+        self.assertEqual(serve.call_count, 2)
+
+    @override_settings(WAGTAIL_AB_TESTING_RESPONSE_CACHE_TIMEOUT=None)
+    def test_disabled(self):
+        with patch.object(
+            Page, "serve", autospec=True, side_effect=Page.serve
+        ) as serve:
+            self.get(AbTest.VERSION_VARIANT)
+            self.get(AbTest.VERSION_VARIANT)
+
+        self.assertEqual(serve.call_count, 2)
+
+
+@override_settings(WAGTAIL_AB_TESTING_STATE_CHECK_INTERVAL=60)
+class TestParticipantCountCache(TestCase):
+    def setUp(self):
+        self.home_page = Page.objects.get(id=2)
+        self.ab_test = AbTest.objects.create(
+            page=self.home_page,
+            name="Test",
+            variant_revision=self.home_page.save_revision(),
+            goal_event="visit-page",
+            sample_size=10,
+            status=AbTest.STATUS_RUNNING,
+        )
+
+    def test_get(self):
+        self.ab_test.add_participant(AbTest.VERSION_VARIANT)
+        self.assertEqual(participant_counts.get(self.ab_test), (0, 1))
+
+        with self.assertNumQueries(0):
+            self.assertEqual(participant_counts.get(self.ab_test), (0, 1))
+
+    def test_incremented_by_add_participant(self):
+        self.assertEqual(participant_counts.get(self.ab_test), (0, 0))
+
+        self.ab_test.add_participant(AbTest.VERSION_CONTROL)
+        self.ab_test.add_participant(AbTest.VERSION_VARIANT)
+        self.ab_test.add_participant(AbTest.VERSION_VARIANT)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(participant_counts.get(self.ab_test), (1, 2))
+
+    @override_settings(WAGTAIL_AB_TESTING_PARTICIPANT_COUNTS_MAX_AGE=0)
+    def test_refreshed_in_background_when_stale(self):
+        participant_counts.get(self.ab_test)
+
+        with patch.object(participant_counts, "_refresh_in_background") as refresh:
+            self.assertEqual(participant_counts.get(self.ab_test), (0, 0))
+
+        refresh.assert_called_once_with(self.ab_test.id)
@@ -68,6 +68,7 @@ class TestWagtailAbTestingScriptTemplateTag(TestCase):
                     "wagtail_ab_testing:register_participant"
                 ),
                 "goalReached": reverse("wagtail_ab_testing:goal_reached"),
+                "events": reverse("wagtail_ab_testing:events"),
             },
             "pageId": self.page.id,
             "testId": self.ab_test.id,
@@ -110,6 +111,7 @@ class TestWagtailAbTestingScriptTemplateTag(TestCase):
                     "wagtail_ab_testing:register_participant"
                 ),
                 "goalReached": reverse("wagtail_ab_testing:goal_reached"),
+                "events": reverse("wagtail_ab_testing:events"),
             },
             "pageId": self.page.id,
             "testId": self.ab_test.id,
@@ -143,6 +145,7 @@ class TestWagtailAbTestingScriptTemplateTag(TestCase):
                     "wagtail_ab_testing:register_participant"
                 ),
                 "goalReached": reverse("wagtail_ab_testing:goal_reached"),
+                "events": reverse("wagtail_ab_testing:events"),
             },
             "pageId": self.page.id,
         }
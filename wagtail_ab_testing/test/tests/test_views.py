@@ -1,12 +1,24 @@
 import datetime
+import json
+from unittest.mock import patch
 
+from asgiref.sync import sync_to_async
 from django.contrib.auth import get_user_model
+from django.test import AsyncRequestFactory, RequestFactory, override_settings
 from django.urls import reverse
 from freezegun import freeze_time
 from rest_framework.test import APIClient, APITestCase
 from wagtail.models import Page
 
+from wagtail_ab_testing.cache import test_statuses
 from wagtail_ab_testing.models import AbTest
+from wagtail_ab_testing.views import (
+    adeltas,
+    aevents,
+    agoal_reached,
+    aregister_participant,
+    register_participant,
+)
 
 
 @freeze_time("2020-11-04T22:37:00Z")
@@ -43,7 +55,7 @@ class TestRegisterParticipant(APITestCase):
             },
         )
 
-        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.status_code, 204)
 
         # This should've created a history log
         log = self.ab_test.hourly_logs.order_by("id").last()
@@ -71,7 +83,7 @@ class TestRegisterParticipant(APITestCase):
             },
         )
 
-        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.status_code, 204)
 
         self.ab_test.refresh_from_db()
         self.assertEqual(self.ab_test.status, AbTest.STATUS_FINISHED)
@@ -94,7 +106,156 @@ class TestRegisterParticipant(APITestCase):
         )
 
         # Shouldn't give 403 error
-        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.status_code, 204)
+
+    async def test_register_participant_async(self):
+        request = AsyncRequestFactory().post(
+            reverse("wagtail_ab_testing:register_participant"),
+            {"test_id": self.ab_test.id, "version": "variant"},
+            content_type="application/json",
+        )
+        response = await aregister_participant(request)
+
+        self.assertEqual(response.status_code, 204)
+
+        log = await self.ab_test.hourly_logs.aget()
+        self.assertEqual(log.version, AbTest.VERSION_VARIANT)
+        self.assertEqual(log.participants, 1)
+
+    def test_register_participant_unknown_test(self):
+        response = self.client.post(
+            reverse("wagtail_ab_testing:register_participant"),
+            {"test_id": self.ab_test.id + 1, "version": "control"},
+        )
+
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json(), "test not found")
+
+    def test_register_participant_paused_test(self):
+        self.ab_test.pause()
+
+        response = self.client.post(
+            reverse("wagtail_ab_testing:register_participant"),
+            {"test_id": self.ab_test.id, "version": "control"},
+        )
+
+        # The event is dropped
+        self.assertEqual(response.status_code, 204)
+        self.assertFalse(self.ab_test.hourly_logs.exists())
+
+    @override_settings(WAGTAIL_AB_TESTING_STATE_CHECK_INTERVAL=60)
+    def test_register_participant_unknown_test_doesnt_query(self):
+        test_statuses.get_status(self.ab_test.id)
+
+        request = RequestFactory().post(
+            reverse("wagtail_ab_testing:register_participant"),
+            {"test_id": 123456, "version": "control"},
+        )
+
+        with self.assertNumQueries(0):
+            response = register_participant(request)
+
+        self.assertEqual(response.status_code, 404)
+
+    async def test_register_participant_async_paused_test(self):
+        await sync_to_async(self.ab_test.pause)()
+
+        request = AsyncRequestFactory().post(
+            reverse("wagtail_ab_testing:register_participant"),
+            {"test_id": self.ab_test.id, "version": "control"},
+            content_type="application/json",
+        )
+        response = await aregister_participant(request)
+
+        self.assertEqual(response.status_code, 204)
+        self.assertFalse(await self.ab_test.hourly_logs.aexists())
+
+    def test_register_participant_invalid_json(self):
+        response = self.client.post(
+            reverse("wagtail_ab_testing:register_participant"),
+            "[",
+            content_type="application/json",
+        )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), "request body must be valid JSON")
+
+    def test_register_participant_get(self):
+        response = self.client.get(reverse("wagtail_ab_testing:register_participant"))
+
+        self.assertEqual(response.status_code, 405)
+
+    def test_register_participant_prunes_assignments(self):
+        finished_test = AbTest.objects.create(
+            page=self.page,
+            name="Finished test",
+            variant_revision=self.page.get_latest_revision(),
+            status=AbTest.STATUS_FINISHED,
+            goal_page_id=2,
+            goal_event="visit-page",
+            sample_size=100,
+        )
+        other_test = AbTest.objects.create(
+            page=self.page,
+            name="Other test",
+            variant_revision=self.page.get_latest_revision(),
+            status=AbTest.STATUS_RUNNING,
+            goal_page_id=2,
+            goal_event="visit-page",
+            sample_size=100,
+        )
+        self.client.cookies["wagtail-ab-testing"] = (
+            f"{self.ab_test.id}:v|{finished_test.id}:c|123456:v"
+        )
+        for test_id in [self.ab_test.id, finished_test.id, other_test.id, 123456]:
+            self.client.cookies[f"wagtail-ab-testing_{test_id}_version"] = "variant"
+
+        response = self.client.post(
+            reverse("wagtail_ab_testing:register_participant"),
+            {"test_id": self.ab_test.id, "version": "variant"},
+        )
+
+        self.assertEqual(response.status_code, 204)
+
+        # The assignments cookie is left to the tracker, which may be adding to it
+        self.assertNotIn("wagtail-ab-testing", response.cookies)
+
+        # Legacy cookies for tests that have ended or that have been migrated are deleted
+        for test_id in [self.ab_test.id, finished_test.id, 123456]:
+            legacy_cookie = response.cookies[f"wagtail-ab-testing_{test_id}_version"]
+            self.assertEqual(legacy_cookie.value, "")
+            self.assertEqual(legacy_cookie["max-age"], 0)
+
+        self.assertNotIn(
+            f"wagtail-ab-testing_{other_test.id}_version", response.cookies
+        )
+
+    def test_register_participant_doesnt_set_up_to_date_assignments(self):
+        self.client.cookies["wagtail-ab-testing"] = f"{self.ab_test.id}:c"
+
+        response = self.client.post(
+            reverse("wagtail_ab_testing:register_participant"),
+            {"test_id": self.ab_test.id, "version": "control"},
+        )
+
+        self.assertEqual(response.status_code, 204)
+        self.assertNotIn("wagtail-ab-testing", response.cookies)
+
+    async def test_register_participant_async_prunes_assignments(self):
+        request = AsyncRequestFactory().post(
+            reverse("wagtail_ab_testing:register_participant"),
+            {"test_id": self.ab_test.id, "version": "variant"},
+            content_type="application/json",
+        )
+        request.COOKIES["wagtail-ab-testing"] = "123456:c"
+        request.COOKIES["wagtail-ab-testing_123456_version"] = "control"
+        response = await aregister_participant(request)
+
+        self.assertEqual(response.status_code, 204)
+        self.assertNotIn("wagtail-ab-testing", response.cookies)
+        self.assertEqual(
+            response.cookies["wagtail-ab-testing_123456_version"]["max-age"], 0
+        )
 
 
 @freeze_time("2020-11-04T22:37:00Z")
@@ -124,7 +285,7 @@ class TestGoalReached(APITestCase):
             {"test_id": self.ab_test.id, "version": "control"},
         )
 
-        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.status_code, 204)
 
         # This should've created a history log
         log = self.ab_test.hourly_logs.get()
@@ -141,7 +302,7 @@ class TestGoalReached(APITestCase):
             {"test_id": self.ab_test.id, "version": "variant"},
         )
 
-        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.status_code, 204)
 
         # This should've created a history log
         log = self.ab_test.hourly_logs.get()
@@ -163,6 +324,52 @@ class TestGoalReached(APITestCase):
         # This shouldn't create a history log
         self.assertFalse(self.ab_test.hourly_logs.exists())
 
+    async def test_log_conversion_async(self):
+        request = AsyncRequestFactory().post(
+            reverse("wagtail_ab_testing:goal_reached"),
+            {"test_id": self.ab_test.id, "version": "control"},
+            content_type="application/json",
+        )
+        response = await agoal_reached(request)
+
+        self.assertEqual(response.status_code, 204)
+
+        log = await self.ab_test.hourly_logs.aget()
+        self.assertEqual(log.conversions, 1)
+
+    async def test_log_conversion_async_unknown_test(self):
+        request = AsyncRequestFactory().post(
+            reverse("wagtail_ab_testing:goal_reached"),
+            {"test_id": self.ab_test.id + 1, "version": "control"},
+            content_type="application/json",
+        )
+
+        response = await agoal_reached(request)
+
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(json.loads(response.content), "test not found")
+
+    def test_log_conversion_finished_test(self):
+        self.ab_test.finish()
+
+        response = self.client.post(
+            reverse("wagtail_ab_testing:goal_reached", args=[]),
+            {"test_id": self.ab_test.id, "version": "control"},
+        )
+
+        # The event is dropped
+        self.assertEqual(response.status_code, 204)
+        self.assertFalse(self.ab_test.hourly_logs.exists())
+
+    def test_log_conversion_invalid_test_id(self):
+        response = self.client.post(
+            reverse("wagtail_ab_testing:goal_reached", args=[]),
+            {"test_id": "foo", "version": "control"},
+        )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), "test_id must be a positive integer")
+
     def test_log_conversion_authenticated_user(self):
         # By default, Django REST framework will enforce CSRF checks on authenticated users
         # We disable these by removing all authentication/permission classes from the view
@@ -178,4 +385,409 @@ class TestGoalReached(APITestCase):
         )
 
         # Shouldn't give 403 error
+        self.assertEqual(response.status_code, 204)
+
+
+@freeze_time("2020-11-04T22:37:00Z")
+class TestEvents(APITestCase):
+    def setUp(self):
+        # Create test page with a draft revision
+        self.page = Page.objects.get(id=2).add_child(
+            instance=Page(title="Test", slug="test")
+        )
+        self.page.title = "Changed title"
+        self.page.save_revision()
+
+        # Create an A/B test
+        self.ab_test = AbTest.objects.create(
+            page=self.page,
+            name="Test",
+            variant_revision=self.page.get_latest_revision(),
+            status=AbTest.STATUS_RUNNING,
+            goal_page_id=2,
+            goal_event="visit-page",
+            sample_size=100,
+            first_started_at=datetime.datetime(
+                2020, 11, 4, 20, 30, tzinfo=datetime.timezone.utc
+            ),
+        )
+
+    def post_events(self, events):
+        return self.client.post(
+            reverse("wagtail_ab_testing:events"), {"events": events}, format="json"
+        )
+
+    def test_events(self):
+        response = self.post_events(
+            [
+                {
+                    "test_id": self.ab_test.id,
+                    "version": "control",
+                    "kind": "participant",
+                },
+                {
+                    "test_id": self.ab_test.id,
+                    "version": "control",
+                    "kind": "participant",
+                },
+                {
+                    "test_id": self.ab_test.id,
+                    "version": "variant",
+                    "kind": "participant",
+                },
+                {
+                    "test_id": self.ab_test.id,
+                    "version": "control",
+                    "kind": "conversion",
+                },
+                {
+                    "test_id": self.ab_test.id,
+                    "version": "variant",
+                    "kind": "conversion",
+                    "time": "2020-11-04T20:15:00Z",
+                },
+            ]
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"accepted": 5})
+
+        self.assertEqual(
+            list(
+                self.ab_test.hourly_logs.values_list(
+                    "version", "date", "hour", "participants", "conversions"
+                )
+            ),
+            [
+                ("control", datetime.date(2020, 11, 4), 22, 2, 1),
+                ("variant", datetime.date(2020, 11, 4), 20, 0, 1),
+                ("variant", datetime.date(2020, 11, 4), 22, 1, 0),
+            ],
+        )
+
+    def test_events_finish_test(self):
+        self.ab_test.sample_size = 2
+        self.ab_test.save()
+
+        response = self.post_events(
+            [
+                {
+                    "test_id": self.ab_test.id,
+                    "version": "control",
+                    "kind": "participant",
+                },
+                {
+                    "test_id": self.ab_test.id,
+                    "version": "variant",
+                    "kind": "participant",
+                },
+            ]
+        )
+        self.assertEqual(response.status_code, 200)
+
+        self.ab_test.refresh_from_db()
+        self.assertEqual(self.ab_test.status, AbTest.STATUS_FINISHED)
+
+    def test_events_for_unknown_tests_are_ignored(self):
+        response = self.post_events(
+            [
+                {
+                    "test_id": self.ab_test.id,
+                    "version": "control",
+                    "kind": "conversion",
+                },
+                {"test_id": 9999, "version": "control", "kind": "conversion"},
+            ]
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"accepted": 1})
+
+    def test_events_for_tests_that_arent_running_are_ignored(self):
+        self.ab_test.pause()
+
+        response = self.post_events(
+            [{"test_id": self.ab_test.id, "version": "control", "kind": "conversion"}]
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"accepted": 0})
+        self.assertFalse(self.ab_test.hourly_logs.exists())
+
+    def test_events_before_the_test_started_are_ignored(self):
+        response = self.post_events(
+            [
+                {
+                    "test_id": self.ab_test.id,
+                    "version": "control",
+                    "kind": "participant",
+                    "time": "1970-01-01T00:00:00Z",
+                },
+                {
+                    "test_id": self.ab_test.id,
+                    "version": "control",
+                    "kind": "conversion",
+                    "time": "2020-11-04T19:59:59Z",
+                },
+                {
+                    "test_id": self.ab_test.id,
+                    "version": "variant",
+                    "kind": "participant",
+                    "time": "2020-11-04T20:00:00Z",
+                },
+            ]
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"accepted": 1})
+        self.assertEqual(
+            list(
+                self.ab_test.hourly_logs.values_list(
+                    "version", "date", "hour", "participants", "conversions"
+                )
+            ),
+            [("variant", datetime.date(2020, 11, 4), 20, 1, 0)],
+        )
+
+    def test_invalid_events(self):
+        for event, message in [
+            ("foo", "each event must be an object"),
+            (
+                {"test_id": "foo", "version": "control", "kind": "conversion"},
+                "test_id must be a positive integer",
+            ),
+            (
+                {"test_id": self.ab_test.id, "version": "foo", "kind": "conversion"},
+                "version must be either 'control' or 'variant'",
+            ),
+            (
+                {"test_id": self.ab_test.id, "version": "control", "kind": "foo"},
+                "kind must be either 'participant' or 'conversion'",
+            ),
+            (
+                {
+                    "test_id": self.ab_test.id,
+                    "version": "control",
+                    "kind": "conversion",
+                    "time": "foo",
+                },
+                "time must be an ISO 8601 date and time",
+            ),
+        ]:
+            with self.subTest(event=event):
+                response = self.post_events([event])
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(response.json(), message)
+
+        # The whole batch is rejected
+        self.assertFalse(self.ab_test.hourly_logs.exists())
+
+    def test_events_must_be_list(self):
+        response = self.client.post(
+            reverse("wagtail_ab_testing:events"), {"events": "foo"}, format="json"
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def test_events_must_be_json(self):
+        response = self.client.post(
+            reverse("wagtail_ab_testing:events"), {"events": "foo"}
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), "request body must be valid JSON")
+
+    async def test_events_async(self):
+        request = AsyncRequestFactory().post(
+            reverse("wagtail_ab_testing:events"),
+            {
+                "events": [
+                    {
+                        "test_id": self.ab_test.id,
+                        "version": "control",
+                        "kind": "participant",
+                    },
+                    {"test_id": 9999, "version": "control", "kind": "conversion"},
+                ]
+            },
+            content_type="application/json",
+        )
+        response = await aevents(request)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content), {"accepted": 1})
+
+        log = await self.ab_test.hourly_logs.aget()
+        self.assertEqual(log.participants, 1)
+
+
+@freeze_time("2020-11-04T22:37:00Z")
+@override_settings(WAGTAIL_AB_TESTING_WORKER_TOKEN="secret")
+class TestDeltas(APITestCase):
+    def setUp(self):
+        self.page = Page.objects.get(id=2).add_child(
+            instance=Page(title="Test", slug="test")
+        )
+        self.page.title = "Changed title"
+        self.page.save_revision()
+
+        self.ab_test = AbTest.objects.create(
+            page=self.page,
+            name="Test",
+            variant_revision=self.page.get_latest_revision(),
+            status=AbTest.STATUS_RUNNING,
+            goal_page_id=2,
+            goal_event="visit-page",
+            sample_size=100,
+            first_started_at=datetime.datetime(
+                2020, 11, 4, 20, 30, tzinfo=datetime.timezone.utc
+            ),
+        )
+
+    def post_deltas(self, deltas, token="secret"):
+        return self.client.post(
+            reverse("wagtail_ab_testing:deltas"),
+            {"deltas": deltas},
+            format="json",
+            HTTP_AUTHORIZATION=f"Token {token}",
+        )
+
+    def test_deltas(self):
+        response = self.post_deltas(
+            [
+                {
+                    "test_id": self.ab_test.id,
+                    "version": "control",
+                    "participants": 10,
+                    "conversions": 3,
+                },
+                {
+                    "test_id": self.ab_test.id,
+                    "version": "variant",
+                    "hour": "2020-11-04T20:00:00Z",
+                    "participants": 12,
+                },
+                {
+                    "test_id": self.ab_test.id + 1,
+                    "version": "variant",
+                    "participants": 5,
+                },
+            ]
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"accepted": 2})
+
+        self.assertEqual(
+            list(
+                self.ab_test.hourly_logs.values_list(
+                    "version", "date", "hour", "participants", "conversions"
+                )
+            ),
+            [
+                ("control", datetime.date(2020, 11, 4), 22, 10, 3),
+                ("variant", datetime.date(2020, 11, 4), 20, 12, 0),
+            ],
+        )
+
+        self.ab_test.refresh_from_db()
+        self.assertEqual(self.ab_test.control_participants, 10)
+        self.assertEqual(self.ab_test.variant_participants, 12)
+
+    def test_deltas_before_the_test_started_are_ignored(self):
+        response = self.post_deltas(
+            [
+                {
+                    "test_id": self.ab_test.id,
+                    "version": "control",
+                    "hour": "1970-01-01T00:00:00Z",
+                    "participants": 10,
+                },
+                {
+                    "test_id": self.ab_test.id,
+                    "version": "variant",
+                    "hour": "2020-11-04T19:00:00Z",
+                    "participants": 10,
+                },
+            ]
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"accepted": 0})
+        self.assertFalse(self.ab_test.hourly_logs.exists())
+
+    @override_settings(WAGTAIL_AB_TESTING_WRITE_BEHIND_INTERVAL=3600)
+    def test_deltas_bypass_write_behind(self):
+        self.post_deltas(
+            [{"test_id": self.ab_test.id, "version": "control", "participants": 1}]
+        )
+
+        self.assertEqual(self.ab_test.hourly_logs.get().participants, 1)
+
+    def test_deltas_finish_test_once(self):
+        self.ab_test.sample_size = 20
+        self.ab_test.save()
+
+        with patch.object(AbTest, "finish", autospec=True) as finish:
+            self.post_deltas(
+                [
+                    {
+                        "test_id": self.ab_test.id,
+                        "version": "control",
+                        "participants": 15,
+                    },
+                    {
+                        "test_id": self.ab_test.id,
+                        "version": "variant",
+                        "participants": 15,
+                    },
+                ]
+            )
+
+        finish.assert_called_once()
+
+    def test_deltas_invalid_token(self):
+        response = self.post_deltas(
+            [{"test_id": self.ab_test.id, "version": "control", "participants": 1}],
+            token="wrong",
+        )
+
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(self.ab_test.hourly_logs.exists())
+
+    @override_settings(WAGTAIL_AB_TESTING_WORKER_TOKEN=None)
+    def test_deltas_without_token_setting(self):
+        response = self.post_deltas(
+            [{"test_id": self.ab_test.id, "version": "control", "participants": 1}],
+            token="None",
+        )
+
+        self.assertEqual(response.status_code, 403)
+
+    def test_deltas_invalid_count(self):
+        response = self.post_deltas(
+            [{"test_id": self.ab_test.id, "version": "control", "participants": -1}]
+        )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), "participants must be a non-negative integer")
+        self.assertFalse(self.ab_test.hourly_logs.exists())
+
+    async def test_deltas_async(self):
+        request = AsyncRequestFactory().post(
+            reverse("wagtail_ab_testing:deltas"),
+            {
+                "deltas": [
+                    {
+                        "test_id": self.ab_test.id,
+                        "version": "variant",
+                        "conversions": 4,
+                    }
+                ]
+            },
+            content_type="application/json",
+            headers={"Authorization": "Token secret"},
+        )
+        response = await adeltas(request)
+
         self.assertEqual(response.status_code, 200)
+        log = await self.ab_test.hourly_logs.aget()
+        self.assertEqual(log.conversions, 4)
@@ -1,11 +1,32 @@
+from django.conf import settings
 from django.urls import path
 
 from . import views
 
 app_name = "wagtail_ab_testing"
+
+# See the comment above the tracking views
+async_tracking = getattr(settings, "WAGTAIL_AB_TESTING_ASYNC_TRACKING", False)
+
 urlpatterns = [
     path(
-        "register-participant/", views.register_participant, name="register_participant"
+        "register-participant/",
+        views.aregister_participant if async_tracking else views.register_participant,
+        name="register_participant",
+    ),
+    path(
+        "goal-reached/",
+        views.agoal_reached if async_tracking else views.goal_reached,
+        name="goal_reached",
+    ),
+    path(
+        "events/",
+        views.aevents if async_tracking else views.events,
+        name="events",
+    ),
+    path(
+        "deltas/",
+        views.adeltas if async_tracking else views.deltas,
+        name="deltas",
     ),
-    path("goal-reached/", views.goal_reached, name="goal_reached"),
 ]
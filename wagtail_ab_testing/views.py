@@ -1,35 +1,57 @@
 import datetime
+import functools
 import json
+from collections import Counter
 
 import django_filters
+from asgiref.sync import iscoroutinefunction, sync_to_async
 from django import forms
+from django.conf import settings
 from django.core.exceptions import PermissionDenied
 from django.core.serializers.json import DjangoJSONEncoder
-from django.db.models import F, Q, Sum
+from django.db.models import F
+from django.http import HttpResponse, HttpResponseNotAllowed, JsonResponse
 from django.shortcuts import get_object_or_404, redirect, render
 from django.template.loader import render_to_string
 from django.urls import reverse
 from django.utils import formats, timezone
+from django.utils.crypto import constant_time_compare
 from django.utils.functional import cached_property
 from django.utils.translation import gettext as _
 from django.utils.translation import gettext_lazy
-from django.views.decorators.csrf import csrf_exempt
 from django_filters.constants import EMPTY_VALUES
-from rest_framework import status
-from rest_framework.decorators import (
-    api_view,
-    authentication_classes,
-    permission_classes,
-)
-from rest_framework.response import Response
 from wagtail.admin import messages, panels
 from wagtail.admin.action_menu import ActionMenuItem
 from wagtail.admin.filters import DateRangePickerWidget, WagtailFilterSet
 from wagtail.admin.views.reports import ReportView
 from wagtail.models import PAGE_MODEL_CLASSES, Page
 
+from .cache import test_statuses
+from .cookies import aprune_assignments, prune_assignments
 from .events import get_event_types
+from .ingest import (
+    DELTA_KIND,
+    EVENT_KIND_CONVERSION,
+    EVENT_KIND_PARTICIPANT,
+    StatsBatch,
+    apply_batch,
+    arecord_batch,
+    arecord_stats,
+    idempotency_keys,
+    parse_delta,
+    parse_event,
+    parse_idempotency_key,
+    record_batch,
+    record_stats,
+)
 from .models import AbTest
+from .ratelimit import get_client_ip, ip_rate_limiter, test_rate_limiter
+
+# The maximum number of events that can be posted to the events endpoint in one request
+MAX_EVENTS_PER_REQUEST = 1000
+
+# The maximum number of deltas that can be posted to the deltas endpoint in one request
+MAX_DELTAS_PER_REQUEST = 1000
 
 
 class CreateAbTestForm(forms.ModelForm):
@@ -335,25 +357,10 @@ class AbTestActionMenu:
 
 
 def get_progress_and_results_common_context(request, page, ab_test):
-    # Fetch stats from database
-    stats = ab_test.hourly_logs.aggregate(
-        control_participants=Sum(
-            "participants", filter=Q(version=AbTest.VERSION_CONTROL)
-        ),
-        control_conversions=Sum(
-            "conversions", filter=Q(version=AbTest.VERSION_CONTROL)
-        ),
-        variant_participants=Sum(
-            "participants", filter=Q(version=AbTest.VERSION_VARIANT)
-        ),
-        variant_conversions=Sum(
-            "conversions", filter=Q(version=AbTest.VERSION_VARIANT)
-        ),
-    )
-    control_participants = stats["control_participants"] or 0
-    control_conversions = stats["control_conversions"] or 0
-    variant_participants = stats["variant_participants"] or 0
-    variant_conversions = stats["variant_conversions"] or 0
+    control_participants = ab_test.control_participants
+    control_conversions = ab_test.control_conversions
+    variant_participants = ab_test.variant_participants
+    variant_conversions = ab_test.variant_conversions
 
     current_sample_size = control_participants + variant_participants
 
@@ -634,67 +641,465 @@ class AbTestingReportView(ReportView):
         )
 
 
-@csrf_exempt
-@api_view(["POST"])
-@authentication_classes([])
-@permission_classes([])
-def register_participant(request):
-    test_id = request.data.get("test_id", None)
+def tracking_view(view_func):
+    """
+    Turns a function into a public tracking endpoint.
+
+    Tracking endpoints only accept POST requests and don't require a CSRF
+    token. Both sync and async functions are supported.
+    """
+    if iscoroutinefunction(view_func):
+
+        @functools.wraps(view_func)
+        async def view(request, *args, **kwargs):
+            if request.method != "POST":
+                return HttpResponseNotAllowed(["POST"])
+
+            return await view_func(request, *args, **kwargs)
+
+    else:
+
+        @functools.wraps(view_func)
+        def view(request, *args, **kwargs):
+            if request.method != "POST":
+                return HttpResponseNotAllowed(["POST"])
+
+            return view_func(request, *args, **kwargs)
+
+    view.csrf_exempt = True
+    return view
+
+
+def load_json_body(request):
+    """
+    Parses the body of a request to a tracking endpoint as a JSON object.
+
+    Raises ValueError with a message describing the problem if it isn't one.
+    """
+    try:
+        data = json.loads(request.body)
+    except ValueError:
+        raise ValueError("request body must be valid JSON") from None
+
+    if not isinstance(data, dict):
+        raise ValueError("request body must be a JSON object")
+
+    return data
+
+
+def parse_tracking_request(request):
+    """
+    Validates the body of a request to the register_participant or goal_reached endpoints.
+
+    The body may be either JSON or form data, and an idempotency key may be
+    sent in the Idempotency-Key header. Returns a (test_id, version, key)
+    tuple, or raises ValueError with a message describing the problem.
+    """
+    if request.content_type == "application/json":
+        data = load_json_body(request)
+    else:
+        data = request.POST
+
+    test_id = data.get("test_id", None)
     if test_id is None:
-        return Response("test_id not provided", status=status.HTTP_400_BAD_REQUEST)
+        raise ValueError("test_id not provided")
 
     try:
         test_id = int(test_id)
         if test_id < 1:
             raise ValueError
-    except ValueError:
-        return Response(
-            "test_id must be a positive integer", status=status.HTTP_400_BAD_REQUEST
-        )
-
-    test = get_object_or_404(AbTest, id=test_id)
+    except (TypeError, ValueError):
+        raise ValueError("test_id must be a positive integer") from None
 
-    version = request.data.get("version", None)
+    version = data.get("version", None)
     if version is None:
-        return Response("version not provided", status=status.HTTP_400_BAD_REQUEST)
+        raise ValueError("version not provided")
 
     if version not in [AbTest.VERSION_CONTROL, AbTest.VERSION_VARIANT]:
-        return Response(
-            f"version must be either '{AbTest.VERSION_CONTROL}' or '{AbTest.VERSION_VARIANT}'",
-            status=status.HTTP_400_BAD_REQUEST,
+        raise ValueError(
+            f"version must be either '{AbTest.VERSION_CONTROL}' or '{AbTest.VERSION_VARIANT}'"
         )
 
-    # Add participant
-    test.add_participant(version=version)
+    key = parse_idempotency_key(request.headers.get("Idempotency-Key"))
 
-    return Response()
+    return test_id, version, key
 
 
-@csrf_exempt
-@api_view(["POST"])
-@authentication_classes([])
-@permission_classes([])
-def goal_reached(request):
-    test_id = request.data.get("test_id", None)
-    if test_id is None:
-        return Response("test_id not provided", status=status.HTTP_400_BAD_REQUEST)
+def parse_events_request(request):
+    """
+    Validates the body of a request to the events endpoint.
 
-    test = get_object_or_404(AbTest, id=test_id)
+    Returns a list of events in the format returned by parse_event(), or
+    raises ValueError with a message describing the problem.
+    """
+    events = load_json_body(request).get("events", None)
+    if not isinstance(events, list):
+        raise ValueError("events must be a list")
 
-    version = request.data.get("version", None)
-    if version is None:
-        return Response("version not provided", status=status.HTTP_400_BAD_REQUEST)
+    if len(events) > MAX_EVENTS_PER_REQUEST:
+        raise ValueError(
+            f"a maximum of {MAX_EVENTS_PER_REQUEST} events can be sent at once"
+        )
 
-    if version not in [AbTest.VERSION_CONTROL, AbTest.VERSION_VARIANT]:
-        return Response(
-            f"version must be either '{AbTest.VERSION_CONTROL}' or '{AbTest.VERSION_VARIANT}'",
-            status=status.HTTP_400_BAD_REQUEST,
+    return [parse_event(event) for event in events]
+
+
+def check_worker_token(request):
+    """
+    Raises PermissionDenied unless the request is authenticated with WAGTAIL_AB_TESTING_WORKER_TOKEN.
+    """
+    token = getattr(settings, "WAGTAIL_AB_TESTING_WORKER_TOKEN", None)
+
+    if not token or not constant_time_compare(
+        request.headers.get("Authorization", ""), "Token " + token
+    ):
+        raise PermissionDenied
+
+
+def parse_deltas_request(request):
+    """
+    Validates the body of a request to the deltas endpoint.
+
+    Returns a list of deltas in the format returned by parse_delta(), or
+    raises ValueError with a message describing the problem.
+    """
+    deltas = load_json_body(request).get("deltas", None)
+    if not isinstance(deltas, list):
+        raise ValueError("deltas must be a list")
+
+    if len(deltas) > MAX_DELTAS_PER_REQUEST:
+        raise ValueError(
+            f"a maximum of {MAX_DELTAS_PER_REQUEST} deltas can be sent at once"
         )
 
-    # Log conversion
-    test.log_conversion(version)
+    return [parse_delta(delta) for delta in deltas]
+
+
+def get_earliest_times(test_ids):
+    """
+    Returns a dictionary of the given test IDs to the earliest time that statistics can be recorded for each one.
+
+    This is the start of the hour that the test was first started in, so
+    clients can't add hourly logs from long before the test was running.
+    Tests that don't have a start time aren't limited.
+    """
+    earliest_times = {}
+    for test_id in test_ids:
+        first_started_at = test_statuses.get_first_started_at(test_id)
+        if first_started_at is not None:
+            first_started_at = first_started_at.astimezone(
+                datetime.timezone.utc
+            ).replace(minute=0, second=0, microsecond=0)
+
+        earliest_times[test_id] = first_started_at
+
+    return earliest_times
+
+
+def is_too_early(test_id, time, earliest_times):
+    earliest_time = earliest_times[test_id]
+    return earliest_time is not None and time < earliest_time
+
+
+def get_deltas_batch(deltas, earliest_times):
+    """
+    Adds the deltas for the test IDs in earliest_times to a new StatsBatch.
+
+    Deltas for tests that don't exist or aren't running are ignored, as are
+    deltas for hours before the test was started. Returns the batch and the
+    number of deltas that were added.
+    """
+    batch = StatsBatch()
+    accepted = 0
+    for test_id, version, hour, participants, conversions, key in deltas:
+        if test_id not in earliest_times or is_too_early(test_id, hour, earliest_times):
+            continue
+
+        batch.add(test_id, version, participants, conversions, time=hour)
+        accepted += 1
+
+    return batch, accepted
+
+
+def count_conversions_by_test(events, test_ids):
+    """
+    Returns a dictionary of the given test IDs to the number of conversions for each one in a list of events.
+
+    Only conversions count towards the rate limit of each test. The tracker
+    assigns visitors to a version before it sends their participant event,
+    so dropping that event would leave later conversions without a
+    participant and inflate the conversion rate.
+    """
+    return Counter(
+        test_id
+        for test_id, version, kind, time, key in events
+        if test_id in test_ids and kind == EVENT_KIND_CONVERSION
+    )
+
+
+def filter_events(events, test_ids, over_limit_test_ids):
+    """
+    Returns the events for the given test IDs, leaving out conversions for tests that are over their rate limit.
+    """
+    return [
+        event
+        for event in events
+        if event[0] in test_ids
+        and not (event[2] == EVENT_KIND_CONVERSION and event[0] in over_limit_test_ids)
+    ]
+
+
+def bad_request_response(error):
+    return JsonResponse(str(error), safe=False, status=400)
+
+
+def test_not_found_response():
+    # This is kept small rather than rendering the site's 404 page, which often queries the database
+    return JsonResponse("test not found", safe=False, status=404)
+
+
+def rate_limited_response():
+    return JsonResponse("rate limit exceeded", safe=False, status=429)
+
+
+def get_event_stats(kind):
+    """
+    Returns the statistics that an event of the given kind adds, as keyword arguments for StatsBatch.add().
+    """
+    if kind == EVENT_KIND_PARTICIPANT:
+        return {"participants": 1}
+
+    return {"conversions": 1}
+
+
+def get_events_batch(events, earliest_times):
+    """
+    Adds the events for the test IDs in earliest_times to a new StatsBatch.
+
+    Events for tests that don't exist or aren't running, and events from
+    before the test was started, are ignored so the rest of the batch isn't
+    lost. Returns the batch and the number of events that were added.
+    """
+    batch = StatsBatch()
+    accepted = 0
+    for test_id, version, kind, time, key in events:
+        if test_id not in earliest_times or is_too_early(test_id, time, earliest_times):
+            continue
+
+        batch.add(test_id, version, time=time, **get_event_stats(kind))
+        accepted += 1
+
+    return batch, accepted
+
+
+# The tracking endpoints have both sync and async implementations.
+# The async ones are used when WAGTAIL_AB_TESTING_ASYNC_TRACKING is set,
+# which saves a thread for each request on sites that are served with ASGI.
+# Running an async view under WSGI is slower than running a sync one.
+
+
+def _track(request, kind):
+    # Records a single event of the given kind for the register_participant and goal_reached endpoints
+    if not ip_rate_limiter.allow(get_client_ip(request)):
+        return rate_limited_response()
+
+    try:
+        test_id, version, key = parse_tracking_request(request)
+    except ValueError as e:
+        return bad_request_response(e)
+
+    ab_test_status = test_statuses.get_status(test_id, request)
+    if ab_test_status is None:
+        return test_not_found_response()
+
+    # Events for tests that aren't running are dropped
+    if ab_test_status == AbTest.STATUS_RUNNING:
+        # Only conversions count towards the rate limit of each test, see count_conversions_by_test()
+        if kind == EVENT_KIND_CONVERSION and not test_rate_limiter.allow(test_id):
+            return rate_limited_response()
+
+        # Retried requests with the same Idempotency-Key header are dropped
+        with idempotency_keys.claim([(test_id, version, key)], kind) as new_events:
+            if new_events:
+                record_stats(test_id, version, **get_event_stats(kind))
+
+    response = HttpResponse(status=204)
+    prune_assignments(request, response)
+    return response
+
+
+async def _atrack(request, kind):
+    # Asynchronous version of _track()
+    if not await ip_rate_limiter.aallow(get_client_ip(request)):
+        return rate_limited_response()
+
+    try:
+        test_id, version, key = parse_tracking_request(request)
+    except ValueError as e:
+        return bad_request_response(e)
+
+    ab_test_status = await test_statuses.aget_status(test_id, request)
+    if ab_test_status is None:
+        return test_not_found_response()
+
+    if ab_test_status == AbTest.STATUS_RUNNING:
+        if kind == EVENT_KIND_CONVERSION and not await test_rate_limiter.aallow(
+            test_id
+        ):
+            return rate_limited_response()
+
+        async with idempotency_keys.aclaim(
+            [(test_id, version, key)], kind
+        ) as new_events:
+            if new_events:
+                await arecord_stats(test_id, version, **get_event_stats(kind))
+
+    response = HttpResponse(status=204)
+    await aprune_assignments(request, response)
+    return response
+
+
+@tracking_view
+def register_participant(request):
+    return _track(request, EVENT_KIND_PARTICIPANT)
+
+
+@tracking_view
+async def aregister_participant(request):
+    return await _atrack(request, EVENT_KIND_PARTICIPANT)
+
+
+@tracking_view
+def goal_reached(request):
+    return _track(request, EVENT_KIND_CONVERSION)
+
+
+@tracking_view
+async def agoal_reached(request):
+    return await _atrack(request, EVENT_KIND_CONVERSION)
+
+
+@tracking_view
+def events(request):
+    try:
+        events = parse_events_request(request)
+    except ValueError as e:
+        return bad_request_response(e)
+
+    if not ip_rate_limiter.allow(get_client_ip(request), max(len(events), 1)):
+        return rate_limited_response()
+
+    test_ids = {
+        test_id
+        for test_id in {event[0] for event in events}
+        if test_statuses.get_status(test_id, request) == AbTest.STATUS_RUNNING
+    }
+
+    over_limit_test_ids = {
+        test_id
+        for test_id, num_conversions in count_conversions_by_test(
+            events, test_ids
+        ).items()
+        if not test_rate_limiter.allow(test_id, num_conversions)
+    }
+
+    with idempotency_keys.claim(
+        filter_events(events, test_ids, over_limit_test_ids)
+    ) as events:
+        batch, accepted = get_events_batch(events, get_earliest_times(test_ids))
+        record_batch(batch, accepted)
+
+    response = JsonResponse({"accepted": accepted})
+    prune_assignments(request, response)
+    return response
+
+
+@tracking_view
+async def aevents(request):
+    try:
+        events = parse_events_request(request)
+    except ValueError as e:
+        return bad_request_response(e)
+
+    if not await ip_rate_limiter.aallow(get_client_ip(request), max(len(events), 1)):
+        return rate_limited_response()
+
+    test_ids = {
+        test_id
+        for test_id in {event[0] for event in events}
+        if await test_statuses.aget_status(test_id, request) == AbTest.STATUS_RUNNING
+    }
+
+    over_limit_test_ids = {
+        test_id
+        for test_id, num_conversions in count_conversions_by_test(
+            events, test_ids
+        ).items()
+        if not await test_rate_limiter.aallow(test_id, num_conversions)
+    }
+
+    async with idempotency_keys.aclaim(
+        filter_events(events, test_ids, over_limit_test_ids)
+    ) as events:
+        batch, accepted = get_events_batch(events, get_earliest_times(test_ids))
+        await arecord_batch(batch, accepted)
+
+    response = JsonResponse({"accepted": accepted})
+    await aprune_assignments(request, response)
+    return response
+
+
+# The deltas endpoint is for workers that count participants and conversions themselves.
+# Each batch is written straight to the database in one transaction, bypassing write-behind,
+# and the sample sizes of the tests in it are only checked once.
+
+
+@tracking_view
+def deltas(request):
+    check_worker_token(request)
+
+    try:
+        deltas = parse_deltas_request(request)
+    except ValueError as e:
+        return bad_request_response(e)
+
+    test_ids = {
+        test_id
+        for test_id in {delta[0] for delta in deltas}
+        if test_statuses.get_status(test_id, request) == AbTest.STATUS_RUNNING
+    }
+
+    with idempotency_keys.claim(
+        [delta for delta in deltas if delta[0] in test_ids], DELTA_KIND
+    ) as deltas:
+        batch, accepted = get_deltas_batch(deltas, get_earliest_times(test_ids))
+        apply_batch(batch)
+
+    return JsonResponse({"accepted": accepted})
+
+
+@tracking_view
+async def adeltas(request):
+    check_worker_token(request)
+
+    try:
+        deltas = parse_deltas_request(request)
+    except ValueError as e:
+        return bad_request_response(e)
+
+    test_ids = {
+        test_id
+        for test_id in {delta[0] for delta in deltas}
+        if await test_statuses.aget_status(test_id, request) == AbTest.STATUS_RUNNING
+    }
+
+    async with idempotency_keys.aclaim(
+        [delta for delta in deltas if delta[0] in test_ids], DELTA_KIND
+    ) as deltas:
+        batch, accepted = get_deltas_batch(deltas, get_earliest_times(test_ids))
+        await sync_to_async(apply_batch)(batch)
 
-    return Response()
+    return JsonResponse({"accepted": accepted})
 
 
 def ab_test_delete(request, page_id):
@@ -1,12 +1,37 @@
+import copy
 import json
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 from django.conf import settings
 from django.contrib.auth.models import Permission
 from django.core.exceptions import PermissionDenied
-from django.http import HttpResponseRedirect, JsonResponse
+from django.core.handlers.asgi import ASGIRequest
+from django.db import close_old_connections
+from django.http import (
+    HttpResponse,
+    HttpResponseBadRequest,
+    HttpResponseRedirect,
+    JsonResponse,
+    StreamingHttpResponse,
+)
+from django.http.response import HttpResponseBase
 from django.shortcuts import redirect
-from django.urls import include, path, reverse
+from django.urls import (
+    clear_script_prefix,
+    get_script_prefix,
+    get_urlconf,
+    include,
+    path,
+    reverse,
+    set_script_prefix,
+    set_urlconf,
+)
+from django.utils import timezone, translation
+from django.utils.cache import patch_vary_headers
 from django.utils.html import escapejs, format_html
+from django.utils.text import compress_sequence
 from django.utils.translation import gettext as _
 from django.utils.translation import gettext_lazy as __
 from django.views.i18n import JavaScriptCatalog
@@ -16,7 +41,14 @@ from wagtail.admin.menu import MenuItem
 from wagtail.admin.staticfiles import versioned_static
 
 from . import views
-from .compat import DATE_FORMAT
+from .cache import (
+    participant_counts,
+    rendered_responses,
+    running_tests,
+    variant_pages,
+)
+from .compat import DATE_FORMAT, brotli
+from .cookies import get_assignments, get_visitor_id
 from .models import AbTest
 from .utils import request_is_trackable
 
@@ -147,69 +179,346 @@ def check_for_running_ab_test(request, page):
         return views.progress(request, page, running_experiment)
 
 
+def get_participant_version(test, request):
+    """
+    Returns the version of the test that the visitor was shown before or None if they aren't a participant.
+    """
+    return get_assignments(request).get(test.id)
+
+
+def serve_version(test, version, page, request, serve_args, serve_kwargs):
+    """
+    Serves and renders the given version of a page that is being tested.
+    """
+    if version == AbTest.VERSION_VARIANT:
+        request.wagtail_ab_testing_serving_variant = True
+        page = variant_pages.get_variant_page(test, request)
+
+    response = page.serve(request, *serve_args, **serve_kwargs)
+
+    if hasattr(response, "render"):
+        response.render()
+
+    return response
+
+
+def serve_cached_version(test, version, page, request, serve_args, serve_kwargs):
+    """
+    Serves the given version of a page that is being tested from the rendered response cache if possible.
+    """
+    if not rendered_responses.is_cacheable_request(request):
+        return serve_version(test, version, page, request, serve_args, serve_kwargs)
+
+    response = rendered_responses.get(request, test, version)
+
+    if response is None:
+        response = serve_version(test, version, page, request, serve_args, serve_kwargs)
+        rendered_responses.set(request, test, version, response)
+
+    return response
+
+
+def serve_both_versions(test, page, request, serve_args, serve_kwargs):
+    """
+    Renders the control and the variant and returns them together in a JSON response.
+    """
+    if getattr(settings, "WAGTAIL_AB_TESTING_WORKER_CONCURRENT_RENDERING", False):
+        # Render the variant in another thread while the control is rendered in this one
+        # The variant gets its own copy of the request so that `wagtail_ab_testing_serving_variant`
+        # is never set on the request that the control is rendered with
+        variant_future = get_render_executor().submit(
+            serve_version_in_thread,
+            translation.get_language(),
+            timezone.get_current_timezone(),
+            get_script_prefix(),
+            get_urlconf(),
+            test,
+            AbTest.VERSION_VARIANT,
+            page,
+            copy_request_for_thread(request),
+            serve_args,
+            serve_kwargs,
+        )
+        control_response = serve_cached_version(
+            test, AbTest.VERSION_CONTROL, page, request, serve_args, serve_kwargs
+        )
+        variant_response = variant_future.result()
+    else:
+        # Note: we must render the control response before setting `wagtail_ab_testing_serving_variant`
+        control_response = serve_cached_version(
+            test, AbTest.VERSION_CONTROL, page, request, serve_args, serve_kwargs
+        )
+        variant_response = serve_cached_version(
+            test, AbTest.VERSION_VARIANT, page, request, serve_args, serve_kwargs
+        )
+
+    response = JsonResponse(
+        {
+            "control": control_response.content.decode("utf-8"),
+            "variant": variant_response.content.decode("utf-8"),
+        }
+    )
+
+    response["X-WagtailAbTesting-Test"] = str(test.id)
+
+    return response
+
+
+def compress_brotli(sequence):
+    compressor = brotli.Compressor()
+
+    for item in sequence:
+        data = compressor.process(item)
+        if data:
+            yield data
+
+    yield compressor.finish()
+
+
+async def iterate_async(iterable):
+    for item in iterable:
+        yield item
+
+
+class StreamingPageResponse(StreamingHttpResponse, HttpResponse):
+    """
+    A StreamingHttpResponse that can be returned from a before_serve_page hook.
+
+    Wagtail ignores anything returned from those hooks that isn't an instance
+    of HttpResponse, so this pretends to be one. The streaming behaviour comes
+    first in the MRO, so it's treated as a streaming response everywhere else.
+
+    The parts of the body must already be rendered, so nothing can fail once
+    the response has started. They are compressed as they are streamed, with
+    an async iterator for requests that are served with ASGI. Code that reads
+    `.content` because it expects an HttpResponse gets the whole body.
+    """
+
+    def __init__(self, parts, *args, content_encoding=None, is_async=False, **kwargs):
+        HttpResponseBase.__init__(self, *args, **kwargs)
+        self.parts = parts
+        self.content_encoding = content_encoding
+
+        if content_encoding:
+            self["Content-Encoding"] = content_encoding
+
+        chunks = self.get_chunks()
+        self.streaming_content = iterate_async(chunks) if is_async else chunks
+
+    def get_chunks(self):
+        if self.content_encoding == "br":
+            return compress_brotli(self.parts)
+
+        if self.content_encoding == "gzip":
+            return compress_sequence(self.parts)
+
+        return iter(self.parts)
+
+    @property
+    def content(self):
+        return b"".join(self.get_chunks())
+
+
+def stream_both_versions(test, page, request, serve_args, serve_kwargs):
+    """
+    Renders the control and the variant and streams them in a multipart/form-data response.
+
+    Both versions are rendered before the response is returned, so any errors
+    are raised while the page is being served instead of cutting off the
+    body of a successful response. The response is compressed with brotli
+    or gzip while it's streamed if the worker accepts it.
+    """
+    boundary = uuid.uuid4().hex
+    parts = []
+
+    # Note: the control is rendered before `wagtail_ab_testing_serving_variant` is set
+    for version in [AbTest.VERSION_CONTROL, AbTest.VERSION_VARIANT]:
+        response = serve_cached_version(
+            test, version, page, request, serve_args, serve_kwargs
+        )
+
+        parts.append(
+            (
+                f"--{boundary}\r\n"
+                f'Content-Disposition: form-data; name="{version}"\r\n'
+                f"Content-Type: {response['Content-Type']}\r\n"
+                "\r\n"
+            ).encode()
+        )
+        parts.append(response.content)
+        parts.append(b"\r\n")
+
+    parts.append(f"--{boundary}--\r\n".encode())
+
+    accept_encoding = request.headers.get("Accept-Encoding", "")
+    if brotli is not None and "br" in accept_encoding:
+        content_encoding = "br"
+    elif "gzip" in accept_encoding:
+        content_encoding = "gzip"
+    else:
+        content_encoding = None
+
+    response = StreamingPageResponse(
+        parts,
+        content_type=f"multipart/form-data; boundary={boundary}",
+        content_encoding=content_encoding,
+        is_async=isinstance(request, ASGIRequest),
+    )
+
+    response["X-WagtailAbTesting-Test"] = str(test.id)
+    patch_vary_headers(response, ["Accept", "Accept-Encoding"])
+
+    return response
+
+
+_render_executor = None
+_render_executor_lock = threading.Lock()
+
+
+def get_render_executor():
+    """
+    Returns the thread pool that is used for rendering variants concurrently with controls.
+    """
+    global _render_executor
+
+    with _render_executor_lock:
+        if _render_executor is None:
+            _render_executor = ThreadPoolExecutor(
+                max_workers=getattr(
+                    settings, "WAGTAIL_AB_TESTING_WORKER_RENDER_THREADS", 4
+                ),
+                thread_name_prefix="wagtail-ab-testing-render",
+            )
+
+        return _render_executor
+
+
+def copy_request_for_thread(request):
+    """
+    Returns a copy of the request for rendering a version in a thread of the render executor.
+
+    The copy shares the lazily loaded user and session with the original, so
+    they're loaded here rather than by both threads at once.
+    """
+    if hasattr(request, "user"):
+        # Reading any attribute loads the user
+        request.user.is_authenticated
+
+    if hasattr(request, "session"):
+        # Loading the session isn't a use of it, so this doesn't add `Vary: Cookie` to the response
+        accessed = request.session.accessed
+        request.session.keys()
+        request.session.accessed = accessed
+
+    return copy.copy(request)
+
+
+def serve_version_in_thread(language, current_timezone, script_prefix, urlconf, *args):
+    """
+    Calls serve_cached_version() from a thread of the render executor.
+
+    The active language, time zone, script prefix and URLconf are
+    thread-local, so they need to be passed in from the thread that is
+    handling the request.
+    """
+    close_old_connections()
+    set_script_prefix(script_prefix)
+    set_urlconf(urlconf)
+
+    try:
+        with translation.override(language), timezone.override(current_timezone):
+            return serve_cached_version(*args)
+    finally:
+        clear_script_prefix()
+        set_urlconf(None)
+        close_old_connections()
+
+
 @hooks.register("before_serve_page")
 def before_serve_page(page, request, serve_args, serve_kwargs):
     # Check if the user is trackable
     if not request_is_trackable(request):
         return
 
+    is_worker_request = (
+        request.META.get("HTTP_X_REQUESTED_WITH") == "WagtailAbTestingWorker"
+    )
+
+    # Save the page so ConversionMiddleware can find out whether it's a goal page
+    # HEAD requests and requests from a worker aren't visits, so they aren't counted
+    if request.method == "GET" and not is_worker_request:
+        request.wagtail_ab_testing_page = page
+
     # Check for a running A/B test on the requested page
-    try:
-        test = AbTest.objects.get(page=page, status=AbTest.STATUS_RUNNING)
-    except AbTest.DoesNotExist:
+    # This is looked up from an in-memory registry so pages without a test don't cost a query
+    test = running_tests.get_for_page(page.id, request)
+    if test is None:
         return
 
     # Save reference to test on request object so it can be found by the {% wagtail_ab_testing_script %} template tag
     request.wagtail_ab_testing_test = test
 
-    # If this request is coming from a frontend worker, return both the control and variant versions
-    # The worker will decide which version to serve to the user
-    if request.META.get("HTTP_X_REQUESTED_WITH") == "WagtailAbTestingWorker":
+    # If this request is coming from a frontend worker, let the worker decide which version to serve to the user
+    if is_worker_request:
         if (
             request.META.get("HTTP_AUTHORIZATION", "")
             != "Token " + settings.WAGTAIL_AB_TESTING_WORKER_TOKEN
         ):
             raise PermissionDenied
 
-        control_response = page.serve(request, *serve_args, **serve_kwargs)
+        requested_version = request.headers.get("X-WagtailAbTesting-Version")
 
-        # Note: we must render the control response before setting `wagtail_ab_testing_serving_variant`
-        if hasattr(control_response, "render"):
-            control_response.render()
+        # Workers that don't ask for a version get both of them
+        if requested_version is None:
+            if "multipart/form-data" in request.headers.get("Accept", ""):
+                return stream_both_versions(
+                    test, page, request, serve_args, serve_kwargs
+                )
 
-        request.wagtail_ab_testing_serving_variant = True
+            return serve_both_versions(test, page, request, serve_args, serve_kwargs)
 
-        variant_response = test.variant_revision.as_object().serve(
-            request, *serve_args, **serve_kwargs
-        )
+        if requested_version not in [AbTest.VERSION_CONTROL, AbTest.VERSION_VARIANT]:
+            return HttpResponseBadRequest(
+                f"X-WagtailAbTesting-Version must be either '{AbTest.VERSION_CONTROL}' or '{AbTest.VERSION_VARIANT}'"
+            )
 
-        if hasattr(variant_response, "render"):
-            variant_response.render()
+        # Participants are always shown the version they saw before, otherwise use the one the worker asked for
+        version = get_participant_version(test, request) or requested_version
 
-        response = JsonResponse(
-            {
-                "control": control_response.content.decode("utf-8"),
-                "variant": variant_response.content.decode("utf-8"),
-            }
+        response = serve_cached_version(
+            test, version, page, request, serve_args, serve_kwargs
         )
-
         response["X-WagtailAbTesting-Test"] = str(test.id)
+        response["X-WagtailAbTesting-Version"] = version
+        patch_vary_headers(response, ["Cookie", "X-WagtailAbTesting-Version"])
 
         return response
 
     # If the user visiting is a participant, show them the same version they saw before
-    if f"wagtail-ab-testing_{test.id}_version" in request.COOKIES:
-        version = request.COOKIES[f"wagtail-ab-testing_{test.id}_version"]
-    else:
+    version = get_participant_version(test, request)
+    visitor_id = get_visitor_id(request)
+    if version is None and visitor_id is not None:
+        # Visitors with a stable ID get a version based on a hash of it, which doesn't need any participant counts
+        version = test.get_version_for_visitor(visitor_id)
+    elif version is None:
         # Otherwise, show them the version of the page that the next participant should see.
         # Note: In order to exclude bots, the browser must call a JavaScript API to sign up as a participant
         # Once they've signed up, they'll get a cookie which keeps them on the same version
-        version = test.get_new_participant_version()
+        # The numbers of participants are approximate as this is called on every page view
+        version = test.get_new_participant_version(
+            participation_numbers=participant_counts.get(test, request)
+        )
+
+    # Anonymous visitors all see the same version of the page, so serve it from the cache if it's enabled
+    if rendered_responses.is_cacheable_request(request):
+        return serve_cached_version(
+            test, version, page, request, serve_args, serve_kwargs
+        )
 
     # If the user should be shown the variant, serve that from the revision. Otherwise return to keep the control
     if version == AbTest.VERSION_VARIANT:
         request.wagtail_ab_testing_serving_variant = True
-        return test.variant_revision.as_object().serve(
+        return variant_pages.get_variant_page(test, request).serve(
             request, *serve_args, **serve_kwargs
         )
 